@@ -0,0 +1,372 @@
+"""asyncio serving mode for the chat backend.
+
+Serves the same /chat and /chat/stream contract as server.py on Quart, so a
+single process can hold many conversations while the model generates:
+
+    hypercorn async_server:app --bind 0.0.0.0:5000
+
+Ollama calls use an async HTTP client, MiniLM encoding runs on the shared,
+bounded worker pool from server.py, and at most ASYNC_MAX_CONCURRENCY
+requests are admitted at once; the rest get an immediate "busy" reply. A
+stream or batch keeps its admission until its response ends. Generations
+wait in server.py's generation scheduler, so LLM_CONCURRENCY, priorities
+and deadlines apply here too.
+"""
+import asyncio
+import contextvars
+import json
+import os
+import time
+
+from quart import Quart, Response, jsonify, request
+from quart_cors import cors
+
+import server
+from generation_scheduler import QueueFull
+from llm_pool import AsyncLLMPool
+from metrics import record, start_trace
+from response_cache import normalize_text
+from single_flight import AsyncSingleFlight
+
+ASYNC_MAX_CONCURRENCY = int(os.environ.get("ASYNC_MAX_CONCURRENCY", "256"))
+
+
+app = cors(Quart(__name__))
+
+# Same backends, routes and health checks as server.py, with async HTTP clients
+llm_client = AsyncLLMPool(server.llm_client)
+admission = asyncio.Semaphore(ASYNC_MAX_CONCURRENCY)
+llm_flights = AsyncSingleFlight()
+server.registry.gauge("async_llm_coalescing", "Async generations in flight, waiting requests and coalescing",
+                      lambda: {(name,): value for name, value in llm_flights.stats().items()}, labels=("stat",))
+
+
+async def run_blocking(func, *args):
+    """Run CPU-bound work such as MiniLM encoding, or a session-store call, on the shared worker pool.
+
+    The request's trace is carried over, so stages timed in the worker show up in its timings.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(server.executor, context.run, func, *args)
+
+
+class AdmittedBody:
+    """Streamed response body that holds an admission slot until Quart closes it.
+
+    Quart closes the body when the stream ends or the client goes away, even
+    if it was never iterated, so a dropped stream cannot keep its slot.
+    """
+
+    def __init__(self, body):
+        self.body = body
+        self.admitted = True
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.body.__anext__()
+
+    async def aclose(self):
+        try:
+            await self.body.aclose()
+        finally:
+            if self.admitted:
+                self.admitted = False
+                admission.release()
+
+
+async def cached_or_none(prompt, query_type):
+    """Return (cached_reply, embedding) for a prompt from the response cache"""
+    embedding = None
+    if server.response_cache.semantic_distance is not None:
+        embedding = await run_blocking(server.query_vector, prompt)
+    return server.response_cache.get(query_type, llm_client.model, prompt, embedding), embedding
+
+
+async def get_llm_response(prompt, query_type, session_id=None):
+    """Async counterpart of server.get_llm_response"""
+    reply = server.canned_reply(query_type)
+    if reply:
+        return reply
+
+    cached, embedding = await cached_or_none(prompt, query_type)
+    if cached:
+        return cached
+
+    fields, uses_history = await run_blocking(server.build_llm_request, prompt, query_type, session_id)
+    priority = server.generation_priority(query_type, fields)
+    deadline = server.generation_deadline()
+
+    async def generate():
+        async with server.generation_scheduler.aslot(priority, deadline) as granted:
+            if not granted:
+                return None
+            return await llm_client.generate(on_context=server.remember_context(session_id, fields),
+                                             query_type=query_type, **fields)
+
+    if uses_history:
+        result = await generate()
+    else:
+        # Identical questions asked at the same moment share one generation
+        result = await llm_flights.do((query_type, llm_client.model, normalize_text(prompt)), generate)
+    if not uses_history:
+        server.response_cache.put(query_type, llm_client.model, prompt, result, embedding)
+    return result
+
+
+async def get_responses(user_message, query_type, mode=None, session_id=None):
+    """Async counterpart of server.parallel_get_responses.
+
+    In race mode an FAQ hit cancels the generation task, which drops it from
+    the generation queue or closes the upstream Ollama request. Raises
+    QueueFull when the generation queue is full and there is no FAQ answer.
+    """
+    mode = mode or server.RESPONSE_MODE
+    find_faq = run_blocking(server.find_best_match, user_message, server.FAQ_THRESHOLD)
+
+    if mode == "staged":
+        faq_response = await find_faq
+        if faq_response:
+            return faq_response, None, "faq"
+        llm_response = await get_llm_response(user_message, query_type, session_id)
+
+    elif mode == "race":
+        llm_task = asyncio.ensure_future(get_llm_response(user_message, query_type, session_id))
+        faq_response = await find_faq
+        if faq_response:
+            llm_task.cancel()
+            return faq_response, None, "faq"
+        llm_response = await llm_task
+
+    else:
+        faq_response, llm_response = await asyncio.gather(
+            find_faq, get_llm_response(user_message, query_type, session_id), return_exceptions=True)
+        if isinstance(faq_response, BaseException):
+            raise faq_response
+        if isinstance(llm_response, BaseException):
+            # A full generation queue only turns the request away when there is no FAQ answer
+            if not (faq_response and isinstance(llm_response, QueueFull)):
+                raise llm_response
+            llm_response = None
+        if faq_response:
+            return faq_response, llm_response, "faq"
+
+    return None, llm_response, "llm" if llm_response else "fallback"
+
+
+def busy():
+    server.chat_replies.inc("busy")
+    response = jsonify({"reply": server.BUSY_REPLY, "source": "system", "path": "busy"})
+    response.status_code = 503
+    response.headers["Retry-After"] = "1"
+    return response
+
+
+@app.route("/metrics")
+async def metrics():
+    """Prometheus-style metrics for this process"""
+    return Response(server.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/reload", methods=["POST"])
+async def admin_reload():
+    """Reload the knowledge base without blocking the event loop"""
+    if not server.admin_allowed(request.headers):
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        return jsonify(await run_blocking(server.knowledge.reload))
+    except Exception as e:
+        print(f"Error reloading knowledge base: {str(e)}")
+        return jsonify({"error": str(e), "version": server.knowledge.current.version}), 400
+
+
+@app.route("/chat", methods=["POST"])
+async def chat():
+    if admission.locked():
+        return busy()
+    async with admission:
+        start_trace()
+        request_start = time.perf_counter()
+        try:
+            data = await request.get_json()
+            user_message = server.chat_message(data)
+            if user_message is None:
+                return jsonify({"error": "message must be a string"}), 400
+            session_id = data.get("session_id")
+
+            await run_blocking(server.record_turn, session_id, "user", user_message)
+
+            if not user_message:
+                return jsonify(server.reply_payload({"reply": "Please enter your question about the Test Centre."},
+                                                    "empty", data))
+
+            query_type = server.detect_query_type(user_message)
+            quick = await run_blocking(server.quick_reply, session_id, user_message, query_type)
+            if quick:
+                reply, source, path = quick
+                await run_blocking(server.record_turn, session_id, "assistant", reply)
+                server.prompts.forget(session_id)
+                record("chat", time.perf_counter() - request_start)
+                return jsonify(server.reply_payload({"reply": reply, "source": source, "path": path}, path, data))
+
+            faq_response, llm_response, path = await get_responses(user_message, query_type,
+                                                                   session_id=session_id)
+            if path != "llm":
+                server.prompts.forget(session_id)
+            final_response = faq_response or llm_response or server.FALLBACK_REPLY
+            await run_blocking(server.record_turn, session_id, "assistant", final_response)
+            record("chat", time.perf_counter() - request_start)
+
+            return jsonify(server.reply_payload({
+                "reply": final_response,
+                "source": "faq" if faq_response else "llm",
+                "path": path
+            }, path, data))
+
+        except QueueFull:
+            return busy()
+        except Exception as e:
+            server.chat_errors.inc()
+            print(f"Error in chat: {str(e)}")
+            return jsonify({
+                "reply": "I'm having trouble processing your request. Please try asking your question again.",
+                "error": str(e)
+            })
+
+
+@app.route("/chat/batch", methods=["POST"])
+async def chat_batch():
+    """Async route for server.answer_batch; results stream back as JSON lines in order.
+
+    A batch takes one admission slot for as long as its results stream.
+    """
+    if admission.locked():
+        return busy()
+    await admission.acquire()
+    body = None
+    try:
+        data = await request.get_json() or {}
+        items = data.get("messages")
+        if not isinstance(items, list) or len(items) > server.BATCH_MAX_MESSAGES:
+            return jsonify({"error": f"messages must be a list of at most {server.BATCH_MAX_MESSAGES} items"}), 400
+        try:
+            server.batch_items(items)
+            concurrency = server.batch_concurrency(data.get("concurrency"))
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        body = AdmittedBody(batch_results(items, concurrency))
+        return Response(body, mimetype="application/x-ndjson")
+    finally:
+        if body is None:
+            admission.release()
+
+
+async def batch_results(items, concurrency):
+    """JSON lines answering one /chat/batch request"""
+    # The batch blocks on its generations, so iterate it from a separate thread
+    results = server.answer_batch(items, concurrency)
+    while True:
+        result = await asyncio.to_thread(next, results, None)
+        if result is None:
+            return
+        yield json.dumps(result) + "\n"
+
+
+@app.route("/chat/stream", methods=["POST"])
+async def chat_stream():
+    if admission.locked():
+        return busy()
+    # Taken before the response is returned, so streams can never outnumber the slots
+    await admission.acquire()
+    body = None
+    try:
+        data = await request.get_json()
+        user_message = server.chat_message(data)
+        if user_message is None:
+            return jsonify({"error": "message must be a string"}), 400
+        session_id = data.get("session_id")
+
+        await run_blocking(server.record_turn, session_id, "user", user_message)
+        body = AdmittedBody(stream_reply(user_message, session_id))
+        return Response(body, mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    finally:
+        if body is None:
+            admission.release()
+
+
+async def stream_reply(user_message, session_id):
+    """Server-sent events answering one /chat/stream request"""
+    if not user_message:
+        yield server.sse_event({"token": "Please enter your question about the Test Centre."})
+        yield server.sse_event({"done": True, "source": "system", "path": "empty"})
+        return
+
+    query_type = server.detect_query_type(user_message)
+    quick = await run_blocking(server.quick_reply, session_id, user_message, query_type)
+    if quick is None:
+        faq_response = await run_blocking(server.find_best_match, user_message, server.FAQ_THRESHOLD)
+        if faq_response:
+            quick = faq_response, "faq", "faq"
+    if quick is None:
+        reply = server.canned_reply(query_type)
+        if reply is None:
+            reply, _ = await cached_or_none(user_message, query_type)
+        if reply:
+            quick = reply, "llm", "llm"
+    if quick:
+        reply, source, path = quick
+        await run_blocking(server.record_turn, session_id, "assistant", reply)
+        server.prompts.forget(session_id)
+        server.chat_replies.inc(path)
+        yield server.sse_event({"token": reply})
+        yield server.sse_event({"done": True, "source": source, "path": path})
+        return
+
+    tokens = []
+    path = "llm"
+    try:
+        fields, uses_history = await run_blocking(server.build_llm_request, user_message, query_type, session_id)
+        remember = server.remember_context(session_id, fields)
+        done = []
+        try:
+            async with server.generation_scheduler.aslot(server.generation_priority(query_type, fields),
+                                                         server.generation_deadline()) as granted:
+                if granted:
+                    async for token in llm_client.stream(on_context=remember, query_type=query_type,
+                                                         on_done=lambda: done.append(True), **fields):
+                        tokens.append(token)
+                        yield server.sse_event({"token": token})
+        except QueueFull:
+            path = "busy"
+            server.prompts.forget(session_id)
+            tokens.append(server.BUSY_REPLY)
+            yield server.sse_event({"token": server.BUSY_REPLY})
+        if not tokens:
+            path = "fallback"
+            server.prompts.forget(session_id)
+            tokens.append(server.FALLBACK_REPLY)
+            yield server.sse_event({"token": server.FALLBACK_REPLY})
+        elif done and not uses_history:
+            # Only replies Ollama finished are cached
+            server.response_cache.put(query_type, llm_client.model, user_message,
+                                      "".join(tokens).strip())
+        server.chat_replies.inc(path)
+        yield server.sse_event({"done": True, "source": "system" if path == "busy" else "llm", "path": path})
+    finally:
+        await run_blocking(server.record_turn, session_id, "assistant", "".join(tokens).strip())
+
+
+@app.before_serving
+async def start_knowledge_watcher():
+    server.start_knowledge_watcher()
+
+
+@app.after_serving
+async def close_llm_client():
+    await llm_client.aclose()
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=5000)
@@ -0,0 +1,69 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchEncoder:
+    """Micro-batching front end for ``SentenceTransformer.encode``.
+
+    Concurrent callers queue their text and a single worker thread flushes the
+    queue as one ``encode(list)`` call once ``max_batch_size`` texts are
+    waiting or ``max_wait_ms`` has passed since the first one arrived. Each
+    caller gets back its own vector.
+    """
+
+    def __init__(self, encode, max_batch_size=32, max_wait_ms=2.0):
+        self._encode = encode
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.batches = 0
+        self.encoded = 0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def _ensure_worker(self):
+        """Start the worker thread, again after a fork since threads don't survive it"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, args=(self._queue,), daemon=True).start()
+                self._pid = os.getpid()
+
+    def encode(self, text, timeout=None):
+        """Encode one string as part of the next batch"""
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future))
+        return future.result(timeout)
+
+    def encode_many(self, texts):
+        """Encode a list of strings in one call, bypassing the queue"""
+        return self._encode(list(texts))
+
+    def _run(self, pending):
+        while True:
+            batch = [pending.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(pending.get(timeout=remaining) if remaining > 0 else pending.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                vectors = self._encode([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            self.batches += 1
+            self.encoded += len(batch)
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
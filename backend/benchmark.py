@@ -0,0 +1,420 @@
+"""Load benchmark and latency-regression suite for the /chat pipeline.
+
+Starts the Flask app against a local stand-in for Ollama, replays a query mix
+built from the FAQ, and reports throughput and p50/p95/p99 latency per path.
+It also micro-benchmarks find_best_match, detect_query_type and startup
+embedding time, and with --ann measures recall against latency of the
+approximate FAQ index on a synthetic knowledge base.
+
+    python benchmark.py                     # run everything and print a report
+    python benchmark.py --save-baseline     # store the numbers as the baseline
+    python benchmark.py --check             # exit 1 if a number regressed
+    python benchmark.py --ann --skip-load   # recall@k vs latency for IVF nprobe values
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from query_cache import QueryCache
+from response_cache import normalize_text
+from retrieval_index import ExactIndex, IVFIndex, normalize_rows
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+
+OFF_TOPIC_PROMPTS = [
+    "Can you recommend a good study playlist",
+    "What is the capital of Australia",
+    "Explain recursion in simple terms",
+    "Is it going to rain tomorrow",
+    "Tell me a joke about exams",
+    "What should I eat before a midterm",
+]
+GREETINGS = ["hi", "hello there", "good morning", "hey"]
+FAREWELLS = ["thanks", "thank you, bye", "got it, see you"]
+OPENERS = ["", "", "hey, ", "quick question: ", "sorry, ", "um "]
+CLOSERS = ["", "", " please", " thanks", " for my exam", " this week"]
+
+
+class MockOllamaHandler(BaseHTTPRequestHandler):
+    """Stand-in for Ollama's /api/generate and /api/tags"""
+
+    protocol_version = "HTTP/1.1"
+    first_token_latency = 0.2
+    token_latency = 0.02
+    tokens = ["This", " is", " a", " mock", " reply", " from", " the", " model."]
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, payload):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_chunk(self, payload):
+        line = (json.dumps(payload) + "\n").encode("utf-8")
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def do_GET(self):
+        self._send_json({"models": [{"name": "qwen:0.5b"}]})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        time.sleep(self.first_token_latency)
+        # Stand-in for the evaluated token ids a follow-up turn can send back
+        context = list(payload.get("context", [])) + list(range(len(payload.get("prompt", "")) // 4 + len(self.tokens)))
+        if not payload.get("stream", True):
+            time.sleep(self.token_latency * (len(self.tokens) - 1))
+            self._send_json({"response": "".join(self.tokens), "done": True, "context": context})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(self.tokens):
+            if i:
+                time.sleep(self.token_latency)
+            self._send_chunk({"response": token, "done": False})
+        self._send_chunk({"response": "", "done": True, "context": context})
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def start_mock_ollama(first_token_latency, token_latency):
+    """Start the mock Ollama server in a thread and return its URL"""
+    handler = type("Handler", (MockOllamaHandler,), {
+        "first_token_latency": first_token_latency,
+        "token_latency": token_latency,
+    })
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_address[1]}"
+
+
+def start_app(app):
+    """Serve the Flask app on a free local port in a thread and return its URL"""
+    from werkzeug.serving import make_server
+
+    httpd = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+def perturb(text, rng):
+    """Return ``text`` reworded the way students type it: an opener or closer and a typo.
+
+    The result misses the exact-match fast path, so the benchmark measures
+    encoding and retrieval instead of a dictionary lookup.
+    """
+    words = text.rstrip("?.!").split()
+    long_words = [i for i, word in enumerate(words) if len(word) > 3]
+    if long_words:
+        i = rng.choice(long_words)
+        word = words[i]
+        j = rng.randrange(len(word) - 1)
+        words[i] = word[:j] + word[j + 1] + word[j] + word[j + 2:]
+    return f"{rng.choice(OPENERS)}{' '.join(words)}{rng.choice(CLOSERS)}"
+
+
+def faq_texts(faq):
+    """Return every FAQ question and variation"""
+    return [item["question"] for item in faq] + [variation for item in faq for variation in item["variations"]]
+
+
+def build_query_mix(faq, rng, count):
+    """Return ``count`` (session_turns, expected_path) scenarios.
+
+    Each scenario is a list of messages sent in one session; only the last
+    message is timed. FAQ questions are perturbed and not repeated, so they
+    miss the query cache as well as the exact-match fast path.
+    """
+    faq_queries = faq_texts(faq)
+    seen = set()
+
+    def faq_query():
+        for _ in range(20):
+            text = perturb(rng.choice(faq_queries), rng)
+            if normalize_text(text) not in seen:
+                break
+        seen.add(normalize_text(text))
+        return text
+
+    kinds = [
+        ("faq", 0.55, lambda: [faq_query()]),
+        ("llm", 0.25, lambda: [f"{rng.choice(OFF_TOPIC_PROMPTS)} #{rng.randrange(10 ** 6)}"]),
+        ("greeting", 0.1, lambda: [rng.choice(GREETINGS)]),
+        ("booking_follow_up", 0.1, lambda: [faq_query(), "how do I book it"]),
+    ]
+    weights = [weight for _, weight, _ in kinds]
+    scenarios = []
+    for _ in range(count):
+        name, _, make = rng.choices(kinds, weights)[0]
+        scenarios.append((make(), name))
+    scenarios += [([rng.choice(FAREWELLS)], "farewell") for _ in range(max(1, count // 50))]
+    rng.shuffle(scenarios)
+    return scenarios
+
+
+def percentiles(samples):
+    """Return count, p50, p95 and p99 (in ms) for a list of seconds"""
+    values = np.asarray(samples) * 1000.0
+    return {
+        "count": len(values),
+        "p50_ms": round(float(np.percentile(values, 50)), 2),
+        "p95_ms": round(float(np.percentile(values, 95)), 2),
+        "p99_ms": round(float(np.percentile(values, 99)), 2),
+    }
+
+
+def run_load(base_url, scenarios, concurrency, stream):
+    """Replay the scenarios against the app and return the load report"""
+    import requests
+
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def run(index, scenario):
+        messages, kind = scenario
+        # Canned greetings and farewells are grouped together; everything else
+        # is grouped by the path the server reports
+        group = "greeting_farewell" if kind in ("greeting", "farewell") else None
+        session_id = f"bench-{index}"
+        for message in messages[:-1]:
+            session().post(f"{base_url}/chat", json={"message": message, "session_id": session_id})
+
+        body = {"message": messages[-1], "session_id": session_id}
+        start = time.perf_counter()
+        if not stream:
+            reply = session().post(f"{base_url}/chat", json=body).json()
+            return group or reply.get("path", "error"), time.perf_counter() - start, None
+
+        first_token = None
+        path = "error"
+        with session().post(f"{base_url}/chat/stream", json=body, stream=True) as response:
+            for line in response.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[6:])
+                if first_token is None:
+                    first_token = time.perf_counter() - start
+                if event.get("done"):
+                    path = event.get("path", "error")
+        return group or path, time.perf_counter() - start, first_token
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, range(len(scenarios)), scenarios))
+    elapsed = time.perf_counter() - started
+
+    by_path = {}
+    for path, latency, _ in results:
+        by_path.setdefault(path, []).append(latency)
+    report = {
+        "requests": len(results),
+        "throughput_rps": round(len(results) / elapsed, 2),
+        "latency": percentiles([latency for _, latency, _ in results]),
+        "by_path": {path: percentiles(samples) for path, samples in sorted(by_path.items())},
+    }
+    if stream:
+        report["time_to_first_token"] = percentiles([ttft for _, _, ttft in results if ttft is not None])
+    return report
+
+
+def time_call(func, args_list, repeat=1):
+    """Return latency percentiles for calling ``func`` on each args tuple"""
+    samples = []
+    for _ in range(repeat):
+        for args in args_list:
+            start = time.perf_counter()
+            func(*args)
+            samples.append(time.perf_counter() - start)
+    return percentiles(samples)
+
+
+def run_micro(server, rng, iterations):
+    """Micro-benchmark the matcher, classifier and startup embedding.
+
+    Queries are perturbed FAQ questions and off-topic prompts, and the query
+    cache is switched off, so every call encodes and matches its message.
+    """
+    from embedding_store import EmbeddingStore
+
+    queries = faq_texts(server.knowledge.current.faq) + OFF_TOPIC_PROMPTS
+    sample = [(perturb(rng.choice(queries), rng),) for _ in range(iterations)]
+
+    startup = {}
+    with tempfile.TemporaryDirectory() as directory:
+        store = EmbeddingStore(directory, server.model.name)
+        start = time.perf_counter()
+        store.load(server.knowledge.current.texts, server.query_encoder.encode_many)
+        startup["cold_ms"] = round((time.perf_counter() - start) * 1000.0, 2)
+        start = time.perf_counter()
+        store.load(server.knowledge.current.texts, server.query_encoder.encode_many)
+        startup["warm_ms"] = round((time.perf_counter() - start) * 1000.0, 2)
+    startup["texts"] = len(server.knowledge.current.texts)
+
+    embedding = server.query_encoder.encode(queries[0])
+    query_cache, server.query_cache = server.query_cache, QueryCache(0)
+    try:
+        return {
+            "find_best_match": time_call(server.find_best_match, sample),
+            "faq_matcher_top_k": time_call(server.knowledge.current.matcher.top_k, [(embedding, 3)] * iterations),
+            "detect_query_type": time_call(server.detect_query_type, sample, repeat=10),
+            "startup_embedding": startup,
+        }
+    finally:
+        server.query_cache = query_cache
+
+
+def build_clustered_corpus(rng, rows, dim, clusters=256):
+    """Random unit vectors grouped around ``clusters`` topics, like a large FAQ"""
+    centres = rng.standard_normal((clusters, dim)).astype(np.float32)
+    members = rng.integers(clusters, size=rows)
+    vectors = centres[members] + 0.5 * rng.standard_normal((rows, dim)).astype(np.float32)
+    queries = centres[rng.integers(clusters, size=200)] + 0.5 * rng.standard_normal((200, dim)).astype(np.float32)
+    return normalize_rows(vectors), normalize_rows(queries)
+
+
+def run_ann(rows, dim, k, nprobes, seed):
+    """Compare the IVF index at several nprobe values with exact search"""
+    rng = np.random.default_rng(seed)
+    vectors, queries = build_clustered_corpus(rng, rows, dim)
+    exact = ExactIndex(vectors, normalized=True)
+    truth = [set(exact.search(query, k)[0].tolist()) for query in queries]
+    report = {"rows": rows, "exact": time_call(exact.search, [(query, k) for query in queries])}
+
+    start = time.perf_counter()
+    index = IVFIndex(vectors, normalized=True, seed=seed)
+    report["ivf_build_ms"] = round((time.perf_counter() - start) * 1000.0, 2)
+    for nprobe in nprobes:
+        index.nprobe = nprobe
+        found = [set(index.search(query, k)[0].tolist()) for query in queries]
+        result = time_call(index.search, [(query, k) for query in queries])
+        result["recall"] = round(float(np.mean([len(f & t) / k for f, t in zip(found, truth)])), 4)
+        report[f"ivf_nprobe_{nprobe}"] = result
+    return report
+
+
+def flatten(report, prefix=""):
+    """Flatten a nested report into {"a.b.c": number}"""
+    flat = {}
+    for key, value in report.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def find_regressions(report, baseline, tolerance, min_delta_ms=1.0):
+    """Return a description of every metric worse than baseline by more than ``tolerance``.
+
+    Latencies must also be at least ``min_delta_ms`` worse, so sub-millisecond
+    noise in the micro-benchmarks does not fail the check.
+    """
+    current = flatten(report)
+    regressions = []
+    for name, expected in flatten(baseline).items():
+        if name not in current or name.endswith((".count", ".texts", ".rows")) or name == "load.requests":
+            continue
+        actual = current[name]
+        if name.endswith(("_rps", ".recall")):
+            worse = actual < expected * (1 - tolerance)
+        else:
+            worse = actual > expected * (1 + tolerance) and actual - expected >= min_delta_ms
+        if worse:
+            regressions.append(f"{name}: {actual} vs baseline {expected}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", type=int, default=300, help="timed /chat requests to send")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent clients")
+    parser.add_argument("--first-token-ms", type=float, default=200, help="mock Ollama latency before the first token")
+    parser.add_argument("--token-ms", type=float, default=20, help="mock Ollama latency between tokens")
+    parser.add_argument("--stream", action="store_true", help="load /chat/stream instead of /chat")
+    parser.add_argument("--iterations", type=int, default=200, help="calls per micro-benchmark")
+    parser.add_argument("--skip-load", action="store_true")
+    parser.add_argument("--skip-micro", action="store_true")
+    parser.add_argument("--ann", action="store_true", help="benchmark the approximate FAQ index")
+    parser.add_argument("--ann-rows", type=int, default=100000, help="synthetic knowledge-base size for --ann")
+    parser.add_argument("--ann-dim", type=int, default=384, help="embedding size for --ann")
+    parser.add_argument("--ann-k", type=int, default=10, help="neighbours compared for recall@k")
+    parser.add_argument("--ann-nprobe", default="1,4,8,16,32", help="comma-separated nprobe values for --ann")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="write this run as the baseline")
+    parser.add_argument("--check", action="store_true", help="fail if a metric regressed past --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="smallest latency increase counted as a regression")
+    parser.add_argument("--output", help="also write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    # Point the app at the mock before it is imported, and keep LLM replies uncached
+    # so the LLM path is measured rather than the response cache
+    os.environ["OLLAMA_HOST"] = start_mock_ollama(args.first_token_ms / 1000.0, args.token_ms / 1000.0)
+    os.environ.setdefault("RESPONSE_CACHE_SIZE", "0")
+    os.environ.setdefault("EMBEDDING_CACHE_DIR", tempfile.mkdtemp(prefix="bench-cache-"))
+
+    start = time.perf_counter()
+    import server
+    report = {"import_ms": round((time.perf_counter() - start) * 1000.0, 2)}
+
+    rng = random.Random(args.seed)
+    if not args.skip_micro:
+        report["micro"] = run_micro(server, rng, args.iterations)
+    if args.ann:
+        nprobes = [int(value) for value in args.ann_nprobe.split(",")]
+        report["ann"] = run_ann(args.ann_rows, args.ann_dim, args.ann_k, nprobes, args.seed)
+    if not args.skip_load:
+        scenarios = build_query_mix(server.knowledge.current.faq, rng, args.requests)
+        report["load"] = run_load(start_app(server.app), scenarios, args.concurrency, args.stream)
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Baseline written to {args.baseline}")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print(f"No baseline at {args.baseline}; run with --save-baseline first")
+            return 1
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = find_regressions(report, json.load(f), args.tolerance, args.min_delta_ms)
+        if regressions:
+            print("Regressions:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
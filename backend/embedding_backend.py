@@ -0,0 +1,245 @@
+"""Embedding backends for FAQ indexing and query encoding.
+
+``torch`` runs the reference SentenceTransformer model. ``onnx`` runs the
+same transformer exported to ONNX, optionally with dynamic int8 weights, on
+onnxruntime with a standalone tokenizer, so serving does not import PyTorch.
+
+    python embedding_backend.py export     # export (and quantize) the model
+    python embedding_backend.py parity     # compare FAQ rankings against torch
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from faq_matcher import FAQMatcher, flatten_faq
+from retrieval_index import normalize_rows
+
+MANIFEST = "backend.json"
+
+
+class SentenceTransformerBackend:
+    """Reference backend: the SentenceTransformer model in PyTorch"""
+
+    kind = "torch"
+
+    def __init__(self, model_name, threads=0):
+        if threads:
+            import torch
+            torch.set_num_threads(threads)
+        from sentence_transformers import SentenceTransformer
+        self.model_name = model_name
+        self.name = model_name
+        self.model = SentenceTransformer(model_name, device="cpu")
+
+    def encode(self, texts):
+        return np.asarray(self.model.encode(texts, convert_to_numpy=True), dtype=np.float32)
+
+
+class OnnxBackend:
+    """Exported transformer on onnxruntime with mean or CLS pooling done in NumPy"""
+
+    kind = "onnx"
+
+    def __init__(self, directory, threads=0):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(directory, MANIFEST), encoding="utf-8") as f:
+            manifest = json.load(f)
+        self.model_name = manifest["model"]
+        self.name = f"{self.model_name}+onnx-{'int8' if manifest['quantized'] else 'fp32'}"
+        self.pooling = manifest["pooling"]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(directory, "tokenizer.json"))
+        self.tokenizer.enable_truncation(manifest["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=manifest["pad_id"], pad_token=manifest["pad_token"])
+
+        options = onnxruntime.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(directory, manifest["file"]), options, providers=["CPUExecutionProvider"])
+        self.input_names = {item.name for item in self.session.get_inputs()}
+
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        encodings = self.tokenizer.encode_batch([texts] if single else list(texts))
+        mask = np.array([encoding.attention_mask for encoding in encodings], dtype=np.int64)
+        inputs = {
+            "input_ids": np.array([encoding.ids for encoding in encodings], dtype=np.int64),
+            "attention_mask": mask,
+            "token_type_ids": np.array([encoding.type_ids for encoding in encodings], dtype=np.int64),
+        }
+        hidden = self.session.run(None, {name: value for name, value in inputs.items()
+                                         if name in self.input_names})[0]
+        if self.pooling == "cls":
+            pooled = hidden[:, 0]
+        else:
+            weights = mask[:, :, None].astype(np.float32)
+            pooled = (hidden * weights).sum(axis=1) / np.maximum(weights.sum(axis=1), 1e-9)
+        vectors = normalize_rows(pooled)
+        return vectors[0] if single else vectors
+
+
+def export_onnx(model_name, directory, quantize=True):
+    """Export a SentenceTransformer model to ONNX, with dynamic int8 weights if ``quantize``"""
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    pooling = "cls" if getattr(model[1], "pooling_mode_cls_token", False) else "mean"
+    os.makedirs(directory, exist_ok=True)
+    tokenizer.save_pretrained(directory)
+
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+
+    class Encoder(torch.nn.Module):
+        # Pass inputs by name; positional order differs between transformers releases
+        def __init__(self):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(names, inputs)))[0]
+
+    axes = {name: {0: "batch", 1: "sequence"} for name in names}
+    axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    fp32_path = os.path.join(directory, "model.onnx")
+    with torch.no_grad():
+        torch.onnx.export(Encoder(), tuple(sample[name] for name in names), fp32_path,
+                          input_names=names, output_names=["last_hidden_state"],
+                          dynamic_axes=axes, opset_version=17, dynamo=False)
+
+    filename = "model.onnx"
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        filename = "model-int8.onnx"
+        quantize_dynamic(fp32_path, os.path.join(directory, filename), weight_type=QuantType.QInt8)
+
+    with open(os.path.join(directory, MANIFEST), "w", encoding="utf-8") as f:
+        json.dump({
+            "model": model_name,
+            "file": filename,
+            "quantized": quantize,
+            "pooling": pooling,
+            "max_seq_length": model.max_seq_length,
+            "pad_id": tokenizer.pad_token_id or 0,
+            "pad_token": tokenizer.pad_token or "[PAD]",
+        }, f, indent=2)
+    print(f"Exported {model_name} to {os.path.join(directory, filename)}")
+
+
+def create_embedding_backend(kind, model_name, onnx_dir=None, quantize=True, threads=0):
+    """Return the configured backend, exporting the ONNX model on first use"""
+    if kind == "torch":
+        return SentenceTransformerBackend(model_name, threads)
+    if kind == "onnx":
+        manifest_path = os.path.join(onnx_dir, MANIFEST)
+        current = None
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding="utf-8") as f:
+                current = json.load(f)
+        if current is None or current["model"] != model_name or current["quantized"] != quantize:
+            export_onnx(model_name, onnx_dir, quantize)
+        return OnnxBackend(onnx_dir, threads)
+    raise ValueError(f"Unknown embedding backend: {kind}")
+
+
+# Paraphrases and keyword queries that are not FAQ variations verbatim
+PARITY_QUERIES = [
+    "how do i email the test centre",
+    "where do i write my test",
+    "room number for testing",
+    "when do I have to book my midterm by",
+    "what is the last day to register for finals",
+    "I forgot to book my exam on time",
+    "how to schedule an accommodated quiz",
+    "do I qualify for test centre services",
+    "extra time on canvas quizzes",
+    "do my accommodations carry over to next semester",
+    "SAS portal",
+    "Charles Hall",
+    "good morning",
+    "what is the capital of Australia",
+    "tell me a joke about exams",
+]
+
+
+def check_parity(reference, candidate, faq, queries=PARITY_QUERIES, k=3, threshold=0.5):
+    """Compare how two backends rank FAQ entries; returns a report dict.
+
+    Reports top-1 agreement, mean top-k overlap, agreement on whether the
+    best score clears ``threshold`` (i.e. FAQ answer vs LLM), and the cosine
+    similarity between the two backends' embeddings of the same texts.
+    """
+    texts, rows = flatten_faq(faq)
+    queries = list(queries)
+    report = {"queries": len(queries)}
+    rankings = []
+    for backend in (reference, candidate):
+        start = time.perf_counter()
+        query_vectors = normalize_rows(backend.encode(queries))
+        report[f"{backend.kind}_encode_ms_per_query"] = round(
+            (time.perf_counter() - start) * 1000.0 / len(queries), 3)
+        text_vectors = normalize_rows(backend.encode(texts))
+        matcher = FAQMatcher(text_vectors, rows, len(faq), normalized=True)
+        rankings.append((text_vectors, query_vectors, [matcher.top_k(vector, k) for vector in query_vectors]))
+
+    (ref_texts, ref_queries, ref_top), (cand_texts, cand_queries, cand_top) = rankings
+    cosines = np.concatenate([(ref_texts * cand_texts).sum(axis=1), (ref_queries * cand_queries).sum(axis=1)])
+    report["top1_agreement"] = round(float(np.mean(
+        [a[0][0] == b[0][0] for a, b in zip(ref_top, cand_top)])), 4)
+    report[f"top{k}_overlap"] = round(float(np.mean(
+        [len({i for i, _ in a} & {i for i, _ in b}) / k for a, b in zip(ref_top, cand_top)])), 4)
+    report["threshold_agreement"] = round(float(np.mean(
+        [(a[0][1] >= threshold) == (b[0][1] >= threshold) for a, b in zip(ref_top, cand_top)])), 4)
+    report["min_cosine"] = round(float(cosines.min()), 4)
+    report["mean_cosine"] = round(float(cosines.mean()), 4)
+    return report
+
+
+def default_onnx_dir(model_name, cache_dir=None):
+    """Directory the server exports the ONNX model to for ``model_name``"""
+    cache_dir = cache_dir or os.environ.get(
+        "EMBEDDING_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+    return os.path.join(cache_dir, "onnx-" + model_name.replace("/", "--"))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=["export", "parity"])
+    parser.add_argument("--model", default=os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2"))
+    parser.add_argument("--onnx-dir", help="where the ONNX model is written (default: the server's)")
+    parser.add_argument("--no-quantize", action="store_true", help="keep fp32 weights")
+    parser.add_argument("--min-top1", type=float, default=0.95, help="parity: required top-1 agreement")
+    parser.add_argument("--min-cosine", type=float, default=0.95, help="parity: required embedding cosine")
+    args = parser.parse_args(argv)
+
+    onnx_dir = args.onnx_dir or default_onnx_dir(args.model)
+    if args.command == "export":
+        export_onnx(args.model, onnx_dir, quantize=not args.no_quantize)
+        return 0
+
+    from knowledge_base import find_document, read_document
+    data_dir = os.environ.get("KNOWLEDGE_BASE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+    faq = read_document(find_document(data_dir, "faq"))
+    reference = SentenceTransformerBackend(args.model)
+    candidate = create_embedding_backend("onnx", args.model, onnx_dir, quantize=not args.no_quantize)
+    report = check_parity(reference, candidate, faq)
+    print(json.dumps(report, indent=2))
+    if report["top1_agreement"] < args.min_top1 or report["min_cosine"] < args.min_cosine:
+        print("Parity check failed")
+        return 1
+    print("Parity check passed")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
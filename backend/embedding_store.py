@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from retrieval_index import normalize_rows
+
+MAGIC = b"FAQEMB1\n"
+# Vectors start on this boundary so the memory map needs no copy
+ALIGNMENT = 64
+
+
+def data_offset(manifest_size):
+    """Return where the vectors start after the magic, the manifest size and the manifest"""
+    return -(-(len(MAGIC) + 8 + manifest_size) // ALIGNMENT) * ALIGNMENT
+
+
+class EmbeddingStore:
+    """On-disk cache of normalized FAQ embeddings.
+
+    Each model has one file, named after a hash of the model. It starts with
+    a JSON manifest holding a hash of the text behind each row, which lets a
+    restart re-encode only the questions and variations that changed, and
+    ends with the float32 vectors, which are loaded memory-mapped so every
+    worker on a host shares the same pages. Rows and manifest are replaced
+    together, so a reader never pairs vectors with another version's keys.
+    """
+
+    def __init__(self, directory, model_name):
+        self.directory = directory
+        self.model_name = model_name
+        self.name = "faq-" + hashlib.sha256(model_name.encode("utf-8")).hexdigest()[:16]
+        self.path = os.path.join(directory, self.name + ".emb")
+
+    def index_path(self, kind):
+        """Return where a retrieval index of the given kind is saved, next to the embeddings"""
+        return os.path.join(self.directory, f"{self.name}.{kind}.npz")
+
+    def fingerprint(self, texts, *options):
+        """Return a hash identifying these texts (in order) and any index options"""
+        digest = hashlib.sha256()
+        for part in [self.key(text) for text in texts] + [str(option) for option in options]:
+            digest.update(part.encode("utf-8"))
+        return digest.hexdigest()[:32]
+
+    def key(self, text):
+        """Return the cache key for one piece of text"""
+        payload = f"{self.model_name}\0{text}".encode("utf-8")
+        return hashlib.sha256(payload).hexdigest()[:32]
+
+    def _read(self):
+        """Return (keys, memory-mapped matrix) from disk, or ([], None)"""
+        try:
+            with open(self.path, "rb") as f:
+                if f.read(len(MAGIC)) != MAGIC:
+                    return [], None
+                size = int.from_bytes(f.read(8), "little")
+                manifest = json.loads(f.read(size).decode("utf-8"))
+            keys, shape = manifest["keys"], tuple(manifest["shape"])
+            if len(keys) != shape[0]:
+                return [], None
+            return keys, np.memmap(self.path, dtype=np.float32, mode="r", offset=data_offset(size), shape=shape)
+        except (OSError, ValueError, KeyError, TypeError):
+            return [], None
+
+    def _write(self, keys, matrix):
+        """Atomically replace the stored keys and matrix with one rename"""
+        matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        manifest = json.dumps({"model": self.model_name, "keys": keys, "shape": list(matrix.shape)}).encode("utf-8")
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.path + f".{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(manifest).to_bytes(8, "little"))
+            f.write(manifest)
+            f.write(b"\0" * (data_offset(len(manifest)) - f.tell()))
+            matrix.tofile(f)
+        os.replace(temp_path, self.path)
+
+    def load(self, texts, encode):
+        """Return a normalized float32 matrix with one row per text.
+
+        ``encode`` is called at most once, with the list of texts that are not
+        already on disk. When nothing changed the memory-mapped file is
+        returned as-is without copying.
+        """
+        if not texts:
+            return np.zeros((0, 0), dtype=np.float32)
+        keys = [self.key(text) for text in texts]
+        cached_keys, cached = self._read()
+        if cached is not None and cached_keys == keys:
+            return cached
+
+        cached_rows = {key: row for row, key in enumerate(cached_keys)}
+        missing = [i for i, key in enumerate(keys) if key not in cached_rows]
+        encoded = None
+        if missing:
+            encoded = normalize_rows(encode([texts[i] for i in missing]))
+
+        dim = encoded.shape[1] if encoded is not None else cached.shape[1]
+        matrix = np.empty((len(texts), dim), dtype=np.float32)
+        missing_rows = {i: n for n, i in enumerate(missing)}
+        for i, key in enumerate(keys):
+            if i in missing_rows:
+                matrix[i] = encoded[missing_rows[i]]
+            else:
+                matrix[i] = cached[cached_rows[key]]
+
+        print(f"Embedding cache: reused {len(texts) - len(missing)}, encoded {len(missing)}")
+        try:
+            self._write(keys, matrix)
+            _, stored = self._read()
+            return stored if stored is not None else matrix
+        except OSError as e:
+            print(f"Could not write embedding cache: {str(e)}")
+            return matrix
@@ -0,0 +1,153 @@
+import numpy as np
+
+from lexical_index import tokenize
+from retrieval_index import ExactIndex
+
+
+def flatten_faq(faq):
+    """Return every FAQ question and variation plus the entry index of each"""
+    texts = []
+    rows = []
+    for entry_index, faq_item in enumerate(faq):
+        texts.append(faq_item["question"])
+        rows.append(entry_index)
+        for variation in faq_item["variations"]:
+            texts.append(variation)
+            rows.append(entry_index)
+    return texts, np.asarray(rows, dtype=np.int32)
+
+
+class FAQMatcher:
+    """Cosine-similarity matcher over all FAQ questions and variations.
+
+    Rows live in a retrieval index and ``row_entries`` maps every row id back
+    to its FAQ entry. With the default exact index, scoring a query is one
+    matrix-vector product over a pre-normalized, contiguous float32 matrix
+    followed by a per-entry max. Pass ``normalized=True`` for rows that are
+    already unit length, such as a memory-mapped matrix from the embedding
+    store, to use them without a copy. Approximate indexes are asked for
+    ``oversample`` rows per requested entry, since several rows can belong to
+    the same entry.
+    """
+
+    def __init__(self, embeddings, row_entries, num_entries, normalized=False, index=None, oversample=8):
+        self.index = index if index is not None else ExactIndex(embeddings, normalized=normalized)
+        self.row_entries = np.ascontiguousarray(row_entries, dtype=np.int32)
+        self.num_entries = num_entries
+        self.oversample = oversample
+        if len(self.index) != len(self.row_entries):
+            raise ValueError("the index and row_entries must have the same length")
+
+    def entry_scores(self, query_embedding, k=None):
+        """Return the best similarity of the query against each FAQ entry.
+
+        Entries the index did not return as candidates score -inf.
+        """
+        if self.index.exhaustive:
+            ids, row_scores = self.index.search(query_embedding)
+        else:
+            ids, row_scores = self.index.search(query_embedding, (k or self.num_entries) * self.oversample)
+        scores = np.full(self.num_entries, -np.inf, dtype=np.float32)
+        np.maximum.at(scores, self.row_entries[ids], row_scores)
+        return scores
+
+    def entry_scores_many(self, query_embeddings, k=None):
+        """Return a (queries, entries) matrix of best similarities.
+
+        The exact index scores the whole batch with one matrix-matrix product;
+        approximate indexes are searched one query at a time.
+        """
+        query_embeddings = np.atleast_2d(query_embeddings)
+        if not self.index.exhaustive:
+            return np.vstack([self.entry_scores(query, k) for query in query_embeddings])
+        ids, row_scores = self.index.search_many(query_embeddings)
+        scores = np.full((len(query_embeddings), self.num_entries), -np.inf, dtype=np.float32)
+        np.maximum.at(scores, (slice(None), self.row_entries[ids]), row_scores)
+        return scores
+
+    def top_k(self, query_embedding, k=3):
+        """Return up to ``k`` (entry_index, score) pairs, best first"""
+        scores = self.entry_scores(query_embedding, k)
+        k = min(k, self.num_entries)
+        if k <= 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(int(i), float(scores[i])) for i in top if np.isfinite(scores[i])]
+
+
+def reciprocal_rank_fusion(score_lists, k=60):
+    """Fuse per-entry score arrays by summing 1 / (k + rank) over each ranking.
+
+    Entries scored -inf or 0 in a list are treated as unranked by it.
+    """
+    fused = np.zeros(len(score_lists[0]), dtype=np.float32)
+    for scores in score_lists:
+        ranked = np.flatnonzero(np.isfinite(scores) & (scores != 0))
+        ranked = ranked[np.argsort(-scores[ranked], kind="stable")]
+        fused[ranked] += 1.0 / (k + 1 + np.arange(len(ranked)))
+    return fused
+
+
+class HybridRetriever:
+    """Combines BM25 keyword scores with dense similarity for FAQ matching.
+
+    ``lexical`` runs before any encoding. An exact question or variation
+    match, or a short query whose terms all occur in a single clearly leading
+    entry, is answered right away. Otherwise ``fuse_scores`` ranks entries by
+    reciprocal rank fusion of the two score lists. The fused winner is
+    accepted when its cosine similarity clears the threshold, or when it is
+    also the clear BM25 leader and clears the lower ``dense_floor``, which
+    catches keyword queries that MiniLM scores low without letting one rare
+    word in an off-topic message pick an answer. Failing both, the best dense
+    match is still accepted if it clears the threshold, so fusion never
+    answers fewer queries than dense matching alone.
+    """
+
+    def __init__(self, rrf_k=60, lexical_max_terms=3, lexical_margin=2.0, dense_floor=0.3, fast_path=True):
+        self.rrf_k = rrf_k
+        self.dense_floor = dense_floor
+        self.lexical_max_terms = lexical_max_terms
+        self.lexical_margin = lexical_margin
+        self.fast_path = fast_path
+
+    def _leader(self, scores):
+        """Return the top BM25 entry if it leads the runner-up by the margin, else None"""
+        if not len(scores):
+            return None
+        order = np.argsort(-scores)[:2]
+        top = scores[order[0]]
+        second = scores[order[1]] if len(order) > 1 else 0.0
+        if top > 0 and top >= self.lexical_margin * second:
+            return int(order[0])
+        return None
+
+    def lexical(self, lexical_index, text):
+        """Return (entry_index or None, method, bm25_scores) without encoding the text"""
+        if self.fast_path:
+            entry = lexical_index.exact_match(text)
+            if entry is not None:
+                return entry, "exact", None
+        tokens = tokenize(text)
+        scores = lexical_index.scores(tokens)
+        if self.fast_path and 0 < len(tokens) <= self.lexical_max_terms:
+            leader = self._leader(scores)
+            if leader is not None and lexical_index.covers(leader, tokens):
+                return leader, "lexical", scores
+        return None, None, scores
+
+    def fuse_scores(self, dense, lexical_scores, threshold):
+        """Return (entry_index or None, best_dense_score, method) from per-entry dense and BM25 scores"""
+        best_dense = float(dense.max()) if len(dense) else -np.inf
+        fused = reciprocal_rank_fusion([dense, lexical_scores], self.rrf_k)
+        if not len(fused) or fused.max() <= 0:
+            return None, best_dense, None
+        winner = int(np.argmax(fused))
+        if dense[winner] >= threshold:
+            return winner, best_dense, "dense" if dense[winner] == best_dense else "hybrid"
+        if dense[winner] >= self.dense_floor and winner == self._leader(lexical_scores):
+            return winner, best_dense, "hybrid"
+        # BM25 can rank another entry first; a confident dense match still answers
+        if best_dense >= threshold:
+            return int(np.argmax(dense)), best_dense, "dense"
+        return None, best_dense, None
@@ -0,0 +1,262 @@
+import asyncio
+import bisect
+import itertools
+import os
+import select
+import socket
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from metrics import record
+
+
+class QueueFull(Exception):
+    """Raised when a generation cannot even be queued"""
+
+
+class GenerationScheduler:
+    """Bounded priority queue in front of the LLM.
+
+    At most ``slots`` generations run at once. Further requests wait in a
+    queue of at most ``max_queue`` entries, served by priority (lower first)
+    and then in arrival order; once the queue is full new requests are
+    rejected at once with QueueFull. A queued request is dropped when its
+    deadline passes or its cancel event is set, so work nobody is waiting
+    for never reaches the model. Time spent queued and generating is recorded
+    as the 'llm_queue' and 'llm_service' stages.
+
+    Threads use ``slot`` and asyncio tasks ``aslot``; both share the same
+    slots and queue, so the async server and the thread pool of the same
+    process never run more than ``slots`` generations between them.
+    """
+
+    def __init__(self, slots=2, max_queue=32, poll_interval=0.1):
+        self.slots = slots
+        self.max_queue = max_queue
+        self.poll_interval = poll_interval
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.expired = 0
+        self.cancelled = 0
+        self._queue = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+
+    def _acquire(self, priority, deadline, cancel_event):
+        """Wait for a slot; return False if the deadline passed or the request was cancelled"""
+        with self._condition:
+            if self.running < self.slots and not self._queue:
+                self.running += 1
+                self.admitted += 1
+                return True
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f"{len(self._queue)} generations already queued")
+            entry = (priority, next(self._order), None)
+            bisect.insort(self._queue, entry)
+            try:
+                while True:
+                    if self._queue[0] == entry and self.running < self.slots:
+                        self._queue.pop(0)
+                        self.running += 1
+                        self.admitted += 1
+                        # The next entry may fit in another free slot
+                        self._dispatch()
+                        self._condition.notify_all()
+                        return True
+                    if cancel_event is not None and cancel_event.is_set():
+                        self.cancelled += 1
+                        break
+                    timeout = None if cancel_event is None else self.poll_interval
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.expired += 1
+                            break
+                        timeout = remaining if timeout is None else min(timeout, remaining)
+                    self._condition.wait(timeout)
+            except BaseException:
+                self._leave(entry)
+                raise
+            self._leave(entry)
+            return False
+
+    async def _acquire_async(self, priority, deadline):
+        """Wait for a slot in an asyncio task; return False if the deadline passed"""
+        loop = asyncio.get_running_loop()
+        with self._condition:
+            if self.running < self.slots and not self._queue:
+                self.running += 1
+                self.admitted += 1
+                return True
+            if len(self._queue) >= self.max_queue:
+                self.rejected += 1
+                raise QueueFull(f"{len(self._queue)} generations already queued")
+            future = loop.create_future()
+            entry = (priority, next(self._order), (loop, future))
+            bisect.insort(self._queue, entry)
+            self._dispatch()
+
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            with self._condition:
+                if isinstance(e, asyncio.TimeoutError):
+                    self.expired += 1
+                else:
+                    self.cancelled += 1
+                if entry in self._queue:
+                    self._leave(entry)
+                else:
+                    # The slot was handed over just as the wait ended
+                    self._free_slot()
+            if isinstance(e, asyncio.CancelledError):
+                raise
+            return False
+
+    def _dispatch(self):
+        """Hand free slots to asyncio waiters at the head of the queue; the lock must be held"""
+        while self._queue and self._queue[0][2] is not None and self.running < self.slots:
+            loop, future = self._queue.pop(0)[2]
+            self.running += 1
+            self.admitted += 1
+            try:
+                loop.call_soon_threadsafe(grant, future)
+            except RuntimeError:
+                # The waiter's event loop is closed
+                self.running -= 1
+
+    def _leave(self, entry):
+        if entry in self._queue:
+            self._queue.remove(entry)
+            self._dispatch()
+            self._condition.notify_all()
+
+    def _free_slot(self):
+        self.running -= 1
+        self._dispatch()
+        self._condition.notify_all()
+
+    def _release(self):
+        with self._condition:
+            self._free_slot()
+
+    @contextmanager
+    def slot(self, priority=0, deadline=None, cancel_event=None):
+        """Hold a generation slot for the block; yields False if the request was dropped.
+
+        ``deadline`` is a time.monotonic() value. Raises QueueFull when the
+        queue is full.
+        """
+        queued = time.perf_counter()
+        if not self._acquire(priority, deadline, cancel_event):
+            record("llm_queue", time.perf_counter() - queued)
+            yield False
+            return
+        started = time.perf_counter()
+        record("llm_queue", started - queued)
+        try:
+            yield True
+        finally:
+            record("llm_service", time.perf_counter() - started)
+            self._release()
+
+    @asynccontextmanager
+    async def aslot(self, priority=0, deadline=None):
+        """asyncio counterpart of ``slot``; cancelling the task drops a queued request"""
+        queued = time.perf_counter()
+        if not await self._acquire_async(priority, deadline):
+            record("llm_queue", time.perf_counter() - queued)
+            yield False
+            return
+        started = time.perf_counter()
+        record("llm_queue", started - queued)
+        try:
+            yield True
+        finally:
+            record("llm_service", time.perf_counter() - started)
+            self._release()
+
+    def stats(self):
+        """Return queue length, running generations and admission counters"""
+        return {
+            "queued": len(self._queue),
+            "running": self.running,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "cancelled": self.cancelled,
+        }
+
+
+def grant(future):
+    """Wake an asyncio waiter that was given a slot, unless it already stopped waiting"""
+    if not future.done():
+        future.set_result(True)
+
+
+def client_socket(environ):
+    """Return the client connection of a WSGI request, or None if the server does not expose it"""
+    sock = environ.get("werkzeug.socket") or environ.get("gunicorn.socket")
+    return sock if isinstance(sock, socket.socket) else None
+
+
+def client_gone(sock):
+    """True if the peer closed the connection; any request body must already be read"""
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT) == b""
+    except BlockingIOError:
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+class DisconnectMonitor:
+    """Sets a request's cancel event when its HTTP client disconnects.
+
+    A WSGI handler blocked on the LLM cannot see the client go away, so one
+    background thread checks every watched connection every ``interval``
+    seconds. The thread is started again after a fork.
+    """
+
+    def __init__(self, interval=0.25):
+        self.interval = interval
+        self.disconnects = 0
+        self._watched = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def watch(self, environ, cancel_event=None):
+        """Return an event that is set when the request's client disconnects"""
+        cancel_event = cancel_event or threading.Event()
+        sock = client_socket(environ)
+        if sock is None:
+            return cancel_event
+        with self._lock:
+            self._watched[cancel_event] = sock
+            if self._pid != os.getpid():
+                threading.Thread(target=self._run, name="disconnect-monitor", daemon=True).start()
+                self._pid = os.getpid()
+        return cancel_event
+
+    def unwatch(self, cancel_event):
+        with self._lock:
+            self._watched.pop(cancel_event, None)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                watched = list(self._watched.items())
+            for cancel_event, sock in watched:
+                if not cancel_event.is_set() and client_gone(sock):
+                    cancel_event.set()
+                    self.disconnects += 1
+                    self.unwatch(cancel_event)
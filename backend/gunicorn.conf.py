@@ -0,0 +1,70 @@
+"""gunicorn settings for serving the Flask chat backend on several cores.
+
+    cd backend
+    WORKERS=4 SESSION_BACKEND=sqlite gunicorn server:app
+
+gunicorn reads this file from the working directory. With ``preload_app`` the
+master imports server.py once, which loads the embedding model, the FAQ
+embedding matrix and the retrieval indexes, and the workers it forks share
+those pages copy-on-write. Each worker answers requests on a fixed pool of
+WORKER_REQUEST_THREADS threads and is capped at WORKER_INTRAOP_THREADS
+intra-op threads (default: CPUs divided by workers), so the workers together
+do not oversubscribe the CPUs.
+"""
+import gc
+import os
+import sys
+
+from metrics import process_memory
+
+MIB = 1024 * 1024
+
+cpus = os.cpu_count() or 1
+bind = f"{os.environ.get('HOST', '0.0.0.0')}:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get("WORKERS", "0")) or cpus
+worker_class = "gthread"
+threads = int(os.environ.get("WORKER_REQUEST_THREADS", "16"))
+backlog = 1024
+preload_app = True
+intraop_threads = int(os.environ.get("WORKER_INTRAOP_THREADS", "0")) or max(1, cpus // workers)
+
+# This file is read before the app is preloaded, so the caps apply to the model
+for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+    os.environ.setdefault(name, str(intraop_threads))
+if not int(os.environ.get("EMBEDDING_THREADS", "0")):
+    os.environ["EMBEDDING_THREADS"] = str(intraop_threads)
+
+
+def format_memory(memory):
+    return ", ".join(f"{kind} {value / MIB:.1f} MiB" for kind, value in memory.items()) or "memory n/a"
+
+
+def when_ready(arbiter):
+    import server
+
+    if server.SESSION_BACKEND == "memory" and workers > 1:
+        arbiter.log.warning("SESSION_BACKEND=memory keeps conversations per worker; use sqlite to share them")
+    # Keep the collector from writing to the shared objects, which would copy their pages into every worker
+    gc.collect()
+    gc.freeze()
+    arbiter.log.info("Master loaded the app: %s", format_memory(process_memory()))
+
+
+def post_fork(arbiter, worker):
+    import server
+
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(intraop_threads)
+    # The watcher only runs in workers; the master never reloads
+    server.start_knowledge_watcher()
+
+
+def post_worker_init(worker):
+    import server
+
+    # Workers forked after `kill -HUP` pick up knowledge-base edits the master never loaded
+    server.knowledge.reload_if_modified()
+    # Start the encoder thread and the intra-op pool before taking traffic
+    server.query_encoder.encode("warm up")
+    worker.log.info("Worker ready with %d request threads and %d intra-op threads: %s",
+                    threads, intraop_threads, format_memory(process_memory()))
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+from faq_matcher import FAQMatcher, flatten_faq
+from lexical_index import BM25Index
+
+DOCUMENTS = ("faq", "context")
+EXTENSIONS = (".json", ".yaml", ".yml")
+
+
+def find_document(directory, name):
+    """Return the path of ``name``.json/.yaml/.yml in ``directory``"""
+    for extension in EXTENSIONS:
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No {name} file in {directory}")
+
+
+def read_document(path):
+    """Parse a JSON or YAML knowledge-base file"""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        # PyYAML is only needed for YAML knowledge bases
+        import yaml
+        return yaml.safe_load(f)
+
+
+def validate(faq, context):
+    """Raise ValueError unless the FAQ and context have the shape the server expects"""
+    if not isinstance(faq, list):
+        raise ValueError("faq must be a list of entries")
+    for number, item in enumerate(faq):
+        if not isinstance(item, dict) or not item.get("question") or not item.get("answer"):
+            raise ValueError(f"faq entry {number} needs a question and an answer")
+        if not isinstance(item.get("variations", []), list):
+            raise ValueError(f"faq entry {number} variations must be a list")
+    if not isinstance(context, dict) or "default" not in context:
+        raise ValueError("context must be a mapping with a 'default' entry")
+
+
+class KnowledgeBase:
+    """One immutable version of the FAQ, the LLM context and the FAQ indexes.
+
+    Request handlers read ``knowledge.current`` once and use that snapshot
+    throughout, so a reload never mixes answers from two versions.
+    """
+
+    def __init__(self, faq, context, texts, matcher, lexical, version):
+        self.faq = faq
+        self.context = context
+        self.texts = texts
+        self.matcher = matcher
+        self.lexical = lexical
+        self.version = version
+
+
+class KnowledgeBaseLoader:
+    """Loads the knowledge base from a data directory and hot-swaps new versions.
+
+    ``reload`` re-reads the files and, if they changed, embeds them through
+    the embedding store, which encodes only the questions and variations it
+    has not seen before. The new snapshot replaces ``current`` in a single
+    assignment while requests continue to be served from the old one.
+    """
+
+    def __init__(self, directory, embedding_store, encode, build_index, on_change=None):
+        self.directory = directory
+        self.embedding_store = embedding_store
+        self.encode = encode
+        self.build_index = build_index
+        self.on_change = on_change
+        self.current = None
+        self.reloads = 0
+        self._mtimes = None
+        self._lock = threading.Lock()
+        self._watcher = None
+        self._watcher_lock = threading.Lock()
+
+    def _mtimes_now(self):
+        return tuple(os.path.getmtime(find_document(self.directory, name)) for name in DOCUMENTS)
+
+    def _read(self):
+        """Return (faq, context, version) from disk"""
+        documents = {name: read_document(find_document(self.directory, name)) for name in DOCUMENTS}
+        validate(documents["faq"], documents["context"])
+        payload = json.dumps(documents, sort_keys=True).encode("utf-8")
+        return documents["faq"], documents["context"], hashlib.sha256(payload).hexdigest()[:16]
+
+    def reload(self):
+        """Load the files and swap in a new snapshot if they changed.
+
+        Returns a summary of what changed. Invalid files raise and leave the
+        current snapshot in place.
+        """
+        with self._lock:
+            # Remember the file times first so a broken edit is reported once, not on every poll
+            self._mtimes = self._mtimes_now()
+            faq, context, version = self._read()
+            previous = self.current
+            if previous is not None and previous.version == version:
+                return {"changed": False, "version": version}
+
+            texts, rows = flatten_faq(faq)
+            old_texts = set(previous.texts) if previous is not None else set()
+            added = len(set(texts) - old_texts)
+            removed = len(old_texts - set(texts))
+            embeddings = self.embedding_store.load(texts, self.encode)
+            previous_index = previous.matcher.index if previous is not None else None
+            matcher = FAQMatcher(None, rows, len(faq), index=self.build_index(texts, embeddings, previous_index))
+
+            self.current = KnowledgeBase(faq, context, texts, matcher, BM25Index(faq), version)
+            self.reloads += 1
+            print(f"Knowledge base {version} loaded: {len(faq)} entries, "
+                  f"{added} texts added, {removed} removed")
+            if self.on_change is not None:
+                self.on_change(self.current, previous)
+            return {"changed": True, "version": version, "entries": len(faq),
+                    "texts_added": added, "texts_removed": removed}
+
+    def reload_if_modified(self):
+        """Reload when a file's modification time changed since the last load"""
+        try:
+            if self._mtimes_now() == self._mtimes:
+                return None
+            return self.reload()
+        except Exception as e:
+            print(f"Error reloading knowledge base: {str(e)}")
+            return None
+
+    def watch(self, interval):
+        """Poll the data directory every ``interval`` seconds in a daemon thread.
+
+        Does nothing while the thread is running, so it can be called on every
+        request; after a fork the thread is started again.
+        """
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                self.reload_if_modified()
+
+        with self._watcher_lock:
+            if self._watcher is None or not self._watcher.is_alive():
+                self._watcher = threading.Thread(target=run, name="knowledge-base-watcher", daemon=True)
+                self._watcher.start()
@@ -0,0 +1,75 @@
+import re
+
+import numpy as np
+
+from response_cache import normalize_text
+
+_TOKEN = re.compile(r"\w+")
+
+STOPWORDS = frozenset("""
+a an and are as at be can do does for from how i if in is it me my of on or
+so that the this to what when where which who will with you your
+""".split())
+
+
+def tokenize(text):
+    """Lower-case word tokens without stopwords; codes such as '343a' are kept whole"""
+    return [token for token in _TOKEN.findall(text.lower()) if token not in STOPWORDS]
+
+
+class BM25Index:
+    """Okapi BM25 over one document per FAQ entry.
+
+    Each document is the entry's question, variations and answer, so rare
+    keywords such as "SAS", "Charles Hall" or "343A" score the entry that
+    mentions them. Postings are precomputed per term, and scoring a query
+    touches only the postings of its terms. Questions and variations are also
+    kept in a normalized-text lookup for exact matches.
+    """
+
+    def __init__(self, faq, k1=1.5, b=0.75):
+        self.num_entries = len(faq)
+        self.exact = {}
+        documents = []
+        for index, item in enumerate(faq):
+            for text in [item["question"]] + list(item.get("variations", [])):
+                self.exact.setdefault(normalize_text(text), index)
+            documents.append(tokenize(" ".join(
+                [item["question"]] + list(item.get("variations", [])) + [item["answer"]])))
+
+        lengths = np.array([len(tokens) for tokens in documents], dtype=np.float32)
+        average = float(lengths.mean()) if len(lengths) and lengths.mean() > 0 else 1.0
+        norms = k1 * (1 - b + b * lengths / average)
+
+        counts = {}
+        for index, tokens in enumerate(documents):
+            for token in tokens:
+                entry_counts = counts.setdefault(token, {})
+                entry_counts[index] = entry_counts.get(index, 0) + 1
+
+        # term -> (entry indices, precomputed BM25 weight per entry)
+        self.postings = {}
+        self.terms = {}
+        for token, entry_counts in counts.items():
+            entries = np.fromiter(entry_counts, dtype=np.int32, count=len(entry_counts))
+            tf = np.fromiter(entry_counts.values(), dtype=np.float32, count=len(entry_counts))
+            idf = np.log(1 + (self.num_entries - len(entries) + 0.5) / (len(entries) + 0.5))
+            self.postings[token] = (entries, idf * tf * (k1 + 1) / (tf + norms[entries]))
+            self.terms[token] = set(entry_counts)
+
+    def exact_match(self, text):
+        """Return the entry whose question or variation is exactly ``text``, or None"""
+        return self.exact.get(normalize_text(text))
+
+    def scores(self, tokens):
+        """Return the BM25 score of every entry for a tokenized query"""
+        scores = np.zeros(self.num_entries, dtype=np.float32)
+        for token in tokens:
+            posting = self.postings.get(token)
+            if posting is not None:
+                np.add.at(scores, posting[0], posting[1])
+        return scores
+
+    def covers(self, entry_index, tokens):
+        """True if every query token occurs in the entry"""
+        return all(entry_index in self.terms.get(token, ()) for token in tokens)
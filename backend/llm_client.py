@@ -0,0 +1,333 @@
+import asyncio
+import json
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class CircuitBreaker:
+    """Fail fast while the model server is unhealthy.
+
+    After ``failure_threshold`` consecutive failures the breaker opens and
+    rejects calls for ``reset_timeout`` seconds. It then lets a single trial
+    call through; success closes it again, failure re-opens it, and a trial
+    that is cancelled first lets the next call try instead.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half-open"
+        return "open"
+
+    def allow(self):
+        """Return True if a call may go through now"""
+        with self._lock:
+            state = self.state
+            if state == "closed":
+                return True
+            if state == "half-open" and not self.trial_running:
+                self.trial_running = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.opened_at is not None or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+    def release_trial(self):
+        """End a trial call that was cancelled before it showed whether the server recovered"""
+        with self._lock:
+            self.trial_running = False
+
+
+class BaseOllamaClient:
+    """Settings, backoff and counters shared by the sync and async clients"""
+
+    def __init__(self, host="http://localhost:11434", model="qwen:0.5b", pool_size=10,
+                 connect_timeout=3.0, read_timeout=60.0, max_retries=3,
+                 backoff_base=0.5, backoff_max=8.0, breaker=None):
+        self.host = host.rstrip("/")
+        self.model = model
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def backoff(self, attempt):
+        """Return the delay before retry number ``attempt`` (0-based)"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def _payload(self, prompt, stream, fields):
+        payload = {"model": self.model, "prompt": prompt, "stream": stream}
+        payload.update(fields)
+        return payload
+
+    def _admit(self):
+        """Return True if the circuit breaker lets a call through"""
+        if self.breaker.allow():
+            return True
+        self.rejected += 1
+        return False
+
+    def _failed(self, attempt, error):
+        self.failures += 1
+        self.breaker.record_failure()
+        print(f"LLM error attempt {attempt + 1}: {str(error)}")
+
+    def stats(self):
+        """Return retry, failure and circuit breaker counters"""
+        return {
+            "host": self.host,
+            "model": self.model,
+            "breaker": self.breaker.state,
+            "retries": self.retries,
+            "failures": self.failures,
+            "rejected": self.rejected,
+        }
+
+
+class OllamaClient(BaseOllamaClient):
+    """Pooled, keep-alive client for an Ollama server.
+
+    Requests share one ``requests.Session`` so connections are reused, use
+    separate connect and read timeouts, and are retried with exponential
+    backoff and full jitter. A circuit breaker makes calls return None
+    immediately while the server keeps failing, so callers fall back to the
+    FAQ or default reply instead of tying up a worker thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.timeout = (self.connect_timeout, self.read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _wait_before_retry(self, attempt, cancel_event):
+        """Sleep before the next attempt; return False if the call should stop"""
+        if attempt == self.max_retries - 1:
+            return False
+        self.retries += 1
+        delay = self.backoff(attempt)
+        if cancel_event is not None:
+            return not cancel_event.wait(delay)
+        time.sleep(delay)
+        return True
+
+    def generate(self, prompt, cancel_event=None, on_context=None, **fields):
+        """Return the full completion for ``prompt``, or None on failure.
+
+        Extra keyword arguments are sent as fields of the /api/generate body.
+        ``on_context`` is called with the ``context`` tokens Ollama returns.
+        With a ``cancel_event`` the reply is streamed, so setting the event
+        closes the upstream request and Ollama stops generating; a stream
+        that stops before Ollama's final chunk returns None, never a fragment.
+        """
+        if cancel_event is not None:
+            done = []
+            text = "".join(self.stream(prompt, cancel_event, on_context, on_done=lambda: done.append(True),
+                                       **fields)).strip()
+            if not done or cancel_event.is_set():
+                return None
+            return text or None
+
+        payload = self._payload(prompt, False, fields)
+        for attempt in range(self.max_retries):
+            if not self._admit():
+                return None
+            try:
+                response = self.session.post(f"{self.host}/api/generate", json=payload, timeout=self.timeout)
+                if response.status_code == 200:
+                    body = response.json()
+                    result = body.get("response", "").strip()
+                    self.breaker.record_success()
+                    if on_context is not None and body.get("context"):
+                        on_context(body["context"])
+                    if result:
+                        return result
+                    return None
+                raise RuntimeError(f"Ollama returned {response.status_code}")
+
+            except Exception as e:
+                self._failed(attempt, e)
+                if not self._wait_before_retry(attempt, None):
+                    return None
+
+        return None
+
+    def stream(self, prompt, cancel_event=None, on_context=None, on_done=None, **fields):
+        """Yield completion tokens as they arrive.
+
+        A failed attempt is only retried if nothing has been yielded yet.
+        ``on_done`` is called once Ollama's final chunk arrived, so callers
+        can tell a complete reply from one cut short by a failure or cancel.
+        """
+        payload = self._payload(prompt, True, fields)
+        for attempt in range(self.max_retries):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            if not self._admit():
+                return
+            started = False
+            try:
+                with self.session.post(f"{self.host}/api/generate", json=payload,
+                                       stream=True, timeout=self.timeout) as response:
+                    if response.status_code != 200:
+                        raise RuntimeError(f"Ollama returned {response.status_code}")
+                    for line in response.iter_lines():
+                        if cancel_event is not None and cancel_event.is_set():
+                            self.breaker.release_trial()
+                            return
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        token = chunk.get("response", "")
+                        if token:
+                            if not started:
+                                # Tokens are flowing, so the server is healthy
+                                self.breaker.record_success()
+                                started = True
+                            yield token
+                        if chunk.get("done"):
+                            if on_context is not None and chunk.get("context"):
+                                on_context(chunk["context"])
+                            break
+                    else:
+                        raise RuntimeError("Ollama closed the stream before the reply was done")
+                self.breaker.record_success()
+                if on_done is not None:
+                    on_done()
+                return
+
+            except GeneratorExit:
+                # The consumer stopped reading, e.g. a streaming client disconnected
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                self._failed(attempt, e)
+                if started or not self._wait_before_retry(attempt, cancel_event):
+                    return
+
+
+class AsyncOllamaClient(BaseOllamaClient):
+    """asyncio counterpart of OllamaClient built on a pooled ``httpx.AsyncClient``.
+
+    Cancelling the awaiting task closes the upstream request, so abandoned
+    generations stop holding the model.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        import httpx
+
+        self.client = httpx.AsyncClient(
+            base_url=self.host,
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+            limits=httpx.Limits(max_connections=self.pool_size,
+                                max_keepalive_connections=self.pool_size))
+
+    async def _sleep_before_retry(self, attempt):
+        if attempt == self.max_retries - 1:
+            return False
+        self.retries += 1
+        await asyncio.sleep(self.backoff(attempt))
+        return True
+
+    async def generate(self, prompt, on_context=None, **fields):
+        """Return the full completion for ``prompt``, or None on failure"""
+        payload = self._payload(prompt, False, fields)
+        for attempt in range(self.max_retries):
+            if not self._admit():
+                return None
+            try:
+                response = await self.client.post("/api/generate", json=payload)
+                if response.status_code == 200:
+                    self.breaker.record_success()
+                    body = response.json()
+                    if on_context is not None and body.get("context"):
+                        on_context(body["context"])
+                    return body.get("response", "").strip() or None
+                raise RuntimeError(f"Ollama returned {response.status_code}")
+
+            except asyncio.CancelledError:
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                self._failed(attempt, e)
+                if not await self._sleep_before_retry(attempt):
+                    return None
+
+        return None
+
+    async def stream(self, prompt, on_context=None, on_done=None, **fields):
+        """Yield completion tokens as they arrive; ``on_done`` is called after Ollama's final chunk"""
+        payload = self._payload(prompt, True, fields)
+        for attempt in range(self.max_retries):
+            if not self._admit():
+                return
+            started = False
+            try:
+                async with self.client.stream("POST", "/api/generate", json=payload) as response:
+                    if response.status_code != 200:
+                        raise RuntimeError(f"Ollama returned {response.status_code}")
+                    async for line in response.aiter_lines():
+                        if not line:
+                            continue
+                        chunk = json.loads(line)
+                        token = chunk.get("response", "")
+                        if token:
+                            if not started:
+                                self.breaker.record_success()
+                                started = True
+                            yield token
+                        if chunk.get("done"):
+                            if on_context is not None and chunk.get("context"):
+                                on_context(chunk["context"])
+                            break
+                    else:
+                        raise RuntimeError("Ollama closed the stream before the reply was done")
+                self.breaker.record_success()
+                if on_done is not None:
+                    on_done()
+                return
+
+            except (asyncio.CancelledError, GeneratorExit):
+                self.breaker.release_trial()
+                raise
+            except Exception as e:
+                self._failed(attempt, e)
+                if started or not await self._sleep_before_retry(attempt):
+                    return
+
+    async def aclose(self):
+        await self.client.aclose()
@@ -0,0 +1,299 @@
+"""Routing and load balancing across several Ollama-compatible servers.
+
+    python llm_pool.py     # probe the backends configured in LLM_BACKENDS
+"""
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+
+from llm_client import AsyncOllamaClient, CircuitBreaker, OllamaClient
+
+
+def parse_backends(value, default_host, default_model):
+    """Return backend dicts from LLM_BACKENDS JSON, or the OLLAMA_HOST backend when unset"""
+    if not value:
+        return [{"host": default_host, "model": default_model}]
+    backends = json.loads(value)
+    if isinstance(backends, dict):
+        backends = [backends]
+    for number, backend in enumerate(backends):
+        if not isinstance(backend, dict) or not backend.get("host"):
+            raise ValueError(f"LLM backend {number} needs a host")
+        backend.setdefault("model", default_model)
+    return backends
+
+
+def model_key(name):
+    """Ollama name of a model with its default ':latest' tag"""
+    return name if ":" in name else name + ":latest"
+
+
+class Backend:
+    """One endpoint and model, with its health and the requests it has in flight"""
+
+    def __init__(self, client, name=None):
+        self.client = client
+        self.host = client.host
+        self.model = client.model
+        self.name = name or f"{client.host}/{client.model}"
+        self.healthy = True
+        self.checked_at = None
+        self.last_error = None
+        self.requests = 0
+
+    @property
+    def available(self):
+        return self.healthy and self.client.breaker.state != "open"
+
+
+class LLMPool:
+    """Sends each generation to one of several Ollama-compatible backends.
+
+    ``routes`` maps a query type to the model, or models in order of
+    preference, that should answer it; a "default" entry covers the other
+    types, and without one they may use any model. Among equally preferred
+    backends the one whose host has the fewest requests in flight is chosen.
+    If a backend fails, the same request fails over to the next one, first
+    to other servers with the routed model and then to the rest of the pool.
+    Backends that failed their last health probe or whose circuit breaker is
+    open are only tried when nothing else is left.
+
+    With more than one backend, a daemon thread probes every backend each
+    ``health_interval`` seconds: /api/tags must list its model, and a backend
+    that is new or was down must also answer a one-token test generation.
+    The pool has the ``generate``/``stream`` interface of OllamaClient plus
+    a ``query_type`` argument.
+    """
+
+    def __init__(self, backends, routes=None, health_interval=30.0, probe_timeout=5.0,
+                 generate_timeout=60.0, keep_alive=None):
+        self.backends = backends
+        self.routes = {query_type: [models] if isinstance(models, str) else list(models)
+                       for query_type, models in (routes or {}).items()}
+        self.health_interval = health_interval
+        self.probe_timeout = probe_timeout
+        self.generate_timeout = generate_timeout
+        self.keep_alive = keep_alive
+        # Names every model, so response cache and single-flight keys change with the pool
+        self.model = ",".join(dict.fromkeys(backend.model for backend in backends))
+        self.failovers = 0
+        self._outstanding = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def candidates(self, query_type=None):
+        """Return the backends to try for a query type, best first"""
+        self._ensure_prober()
+        models = self.routes.get(query_type, self.routes.get("default", []))
+
+        def preference(backend):
+            rank = models.index(backend.model) if backend.model in models else len(models)
+            return (not backend.available, rank, self._outstanding.get(backend.host, 0), random.random())
+
+        with self._lock:
+            return sorted(self.backends, key=preference)
+
+    @contextmanager
+    def _track(self, backend):
+        with self._lock:
+            self._outstanding[backend.host] = self._outstanding.get(backend.host, 0) + 1
+            backend.requests += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._outstanding[backend.host] -= 1
+
+    def _failover(self, attempt, backend):
+        if attempt:
+            self.failovers += 1
+            print(f"Failing over to LLM backend {backend.name}")
+
+    def generate(self, prompt, cancel_event=None, on_context=None, query_type=None, **fields):
+        """Return the full completion from the first backend that answers, or None"""
+        for attempt, backend in enumerate(self.candidates(query_type)):
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            self._failover(attempt, backend)
+            with self._track(backend):
+                result = backend.client.generate(prompt, cancel_event, on_context, **fields)
+            if result is not None:
+                return result
+        return None
+
+    def stream(self, prompt, cancel_event=None, on_context=None, query_type=None, on_done=None, **fields):
+        """Yield completion tokens, failing over only while nothing has been yielded.
+
+        ``on_done`` is called when the reply is complete, as in OllamaClient.stream.
+        """
+        for attempt, backend in enumerate(self.candidates(query_type)):
+            if cancel_event is not None and cancel_event.is_set():
+                return
+            self._failover(attempt, backend)
+            started = False
+            with self._track(backend):
+                for token in backend.client.stream(prompt, cancel_event, on_context, on_done, **fields):
+                    started = True
+                    yield token
+            if started:
+                return
+
+    def probe(self, backend):
+        """Check that a backend lists its model and, if it was not known to be up, can generate"""
+        try:
+            response = requests.get(f"{backend.host}/api/tags", timeout=self.probe_timeout)
+            if response.status_code != 200:
+                raise RuntimeError(f"/api/tags returned {response.status_code}")
+            names = {model_key(item.get("name", "")) for item in response.json().get("models", [])}
+            if model_key(backend.model) not in names:
+                raise RuntimeError(f"model {backend.model} is not available")
+            if not backend.healthy or backend.checked_at is None:
+                payload = {"model": backend.model, "prompt": "Say hello", "stream": False,
+                           "options": {"num_predict": 1}}
+                if self.keep_alive:
+                    payload["keep_alive"] = self.keep_alive
+                response = requests.post(f"{backend.host}/api/generate", json=payload,
+                                         timeout=(self.probe_timeout, self.generate_timeout))
+                if response.status_code != 200:
+                    raise RuntimeError(f"test generation returned {response.status_code}")
+            healthy, error = True, None
+        except Exception as e:
+            healthy, error = False, str(e)
+
+        if healthy != backend.healthy or backend.checked_at is None:
+            print(f"LLM backend {backend.name} is {'up' if healthy else 'down: ' + error}")
+        backend.healthy, backend.last_error, backend.checked_at = healthy, error, time.time()
+        return healthy
+
+    def probe_all(self):
+        """Probe every backend at once and return {name: healthy}"""
+        threads = [threading.Thread(target=self.probe, args=(backend,), daemon=True) for backend in self.backends]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {backend.name: backend.healthy for backend in self.backends}
+
+    def _ensure_prober(self):
+        """Start the health-check thread, again after a fork since threads don't survive it"""
+        if len(self.backends) < 2 or self.health_interval <= 0 or self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                threading.Thread(target=self._probe_forever, name="llm-health", daemon=True).start()
+                self._pid = os.getpid()
+
+    def _probe_forever(self):
+        while True:
+            self.probe_all()
+            time.sleep(self.health_interval)
+
+    @property
+    def retries(self):
+        return sum(backend.client.retries for backend in self.backends)
+
+    @property
+    def failures(self):
+        return sum(backend.client.failures for backend in self.backends)
+
+    @property
+    def rejected(self):
+        return sum(backend.client.rejected for backend in self.backends)
+
+    @property
+    def open_breakers(self):
+        return sum(backend.client.breaker.state == "open" for backend in self.backends)
+
+    def stats(self):
+        """Return per-backend health and load as {(backend, stat): value}"""
+        stats = {}
+        with self._lock:
+            for backend in self.backends:
+                stats[(backend.name, "healthy")] = int(backend.healthy)
+                stats[(backend.name, "breaker_open")] = int(backend.client.breaker.state == "open")
+                stats[(backend.name, "outstanding")] = self._outstanding.get(backend.host, 0)
+                stats[(backend.name, "requests")] = backend.requests
+                stats[(backend.name, "failures")] = backend.client.failures
+        return stats
+
+
+class AsyncLLMPool:
+    """asyncio counterpart of LLMPool that shares its backends, health and load counts.
+
+    Each backend gets an AsyncOllamaClient with the sync client's settings
+    and circuit breaker.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.model = pool.model
+        self.clients = {}
+        for backend in pool.backends:
+            client = backend.client
+            self.clients[backend.name] = AsyncOllamaClient(
+                client.host, client.model, pool_size=client.pool_size,
+                connect_timeout=client.connect_timeout, read_timeout=client.read_timeout,
+                max_retries=client.max_retries, breaker=client.breaker)
+
+    async def generate(self, prompt, on_context=None, query_type=None, **fields):
+        for attempt, backend in enumerate(self.pool.candidates(query_type)):
+            self.pool._failover(attempt, backend)
+            with self.pool._track(backend):
+                result = await self.clients[backend.name].generate(prompt, on_context, **fields)
+            if result is not None:
+                return result
+        return None
+
+    async def stream(self, prompt, on_context=None, query_type=None, on_done=None, **fields):
+        for attempt, backend in enumerate(self.pool.candidates(query_type)):
+            self.pool._failover(attempt, backend)
+            started = False
+            with self.pool._track(backend):
+                async for token in self.clients[backend.name].stream(prompt, on_context, on_done, **fields):
+                    started = True
+                    yield token
+            if started:
+                return
+
+    async def aclose(self):
+        for client in self.clients.values():
+            await client.aclose()
+
+
+def create_llm_pool(entries, routes=None, health_interval=30.0, keep_alive=None,
+                    breaker_threshold=5, breaker_reset=30.0, max_retries=3, **client_options):
+    """Build an LLMPool from backend dicts ({"host", "model", optional "name" and "max_retries"}).
+
+    A single backend keeps ``max_retries`` attempts; with several, each
+    backend gets one attempt by default, since failing over replaces retrying.
+    """
+    default_retries = max_retries if len(entries) == 1 else 1
+    backends = []
+    for entry in entries:
+        client = OllamaClient(entry["host"], entry["model"],
+                              max_retries=int(entry.get("max_retries", default_retries)),
+                              breaker=CircuitBreaker(breaker_threshold, breaker_reset), **client_options)
+        backends.append(Backend(client, entry.get("name")))
+    return LLMPool(backends, routes, health_interval, keep_alive=keep_alive)
+
+
+def main():
+    entries = parse_backends(os.environ.get("LLM_BACKENDS"), os.environ.get("OLLAMA_HOST", "http://localhost:11434"),
+                             os.environ.get("OLLAMA_MODEL", "qwen:0.5b"))
+    pool = create_llm_pool(entries, json.loads(os.environ.get("LLM_ROUTES") or "{}"), health_interval=0)
+    pool.probe_all()
+    for backend in pool.backends:
+        print(f"- {backend.name}: {'up' if backend.healthy else 'down'}")
+    for query_type in ["default"] + sorted(set(pool.routes) - {"default"}):
+        print(f"{query_type}: {', '.join(backend.name for backend in pool.candidates(query_type))}")
+    return 0 if any(backend.healthy for backend in pool.backends) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
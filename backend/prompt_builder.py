@@ -0,0 +1,139 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+# Per query type instruction appended to the system prompt
+INSTRUCTIONS = {
+    "location": "Provide specific location details in a clear, helpful way.",
+    "booking": "Provide specific booking information and next steps.",
+    "accommodation": "Explain accommodation details clearly.",
+    "conversation": "Be friendly but professional.",
+}
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting, about four characters per token"""
+    return len(text) // 4 + 1
+
+
+class PromptBuilder:
+    """Builds Ollama /api/generate bodies for the Test Centre assistant.
+
+    The static Test Centre context goes in the ``system`` field and stays
+    byte-identical per query type, so Ollama can reuse its evaluated prefix.
+    The ``context`` tokens Ollama returns at the end of a reply are kept per
+    session and sent back on the next turn, so earlier turns are not evaluated
+    again. They already hold the system prompt, and Ollama would render a
+    ``system`` field again after them, so follow-up turns leave it out; the
+    tokens are only reused while the system prompt they were built with is
+    still current. Without reusable tokens, the most
+    recent history turns that fit in ``history_tokens`` are written into the
+    prompt instead. ``keep_alive`` keeps the model loaded between requests.
+    """
+
+    def __init__(self, history_tokens=512, max_context_tokens=2048, keep_alive="30m",
+                 options=None, max_sessions=10000, ttl_seconds=3600):
+        self.history_tokens = history_tokens
+        self.max_context_tokens = max_context_tokens
+        self.keep_alive = keep_alive
+        self.options = options or {}
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self.reused = 0
+        self.windowed = 0
+        self._contexts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def system_prompt(self, context, query_type):
+        """Return the static system prompt for a query type"""
+        system = context.get(query_type, context["default"]).strip()
+        instruction = INSTRUCTIONS.get(query_type)
+        if instruction:
+            system = f"{system}\n\n{instruction}"
+        return system
+
+    def history_window(self, history):
+        """Return the most recent turns that fit the token budget, oldest first"""
+        lines = []
+        budget = self.history_tokens
+        for item in reversed(history):
+            line = f"{'Student' if item.role == 'user' else 'Assistant'}: {item.message}"
+            budget -= estimate_tokens(line)
+            if budget < 0:
+                break
+            lines.append(line)
+        return lines[::-1]
+
+    def build(self, context, question, query_type, session_id=None, history=()):
+        """Return (fields, uses_history) for one generation.
+
+        ``history`` holds the earlier turns of the session, without the
+        current question. ``uses_history`` tells the caller the reply
+        depends on the conversation, not only on the question.
+        """
+        system = self.system_prompt(context, query_type)
+        fields = {"system": system, "keep_alive": self.keep_alive}
+        if self.options:
+            fields["options"] = dict(self.options)
+
+        tokens = self._tokens(session_id, system)
+        if tokens and len(tokens) + estimate_tokens(question) <= self.max_context_tokens:
+            self.reused += 1
+            del fields["system"]
+            fields["context"] = tokens
+            fields["prompt"] = question
+            return fields, True
+
+        lines = self.history_window(history) if self.history_tokens > 0 else []
+        if lines:
+            self.windowed += 1
+            fields["prompt"] = "\n".join(["Conversation so far:"] + lines + [f"Student: {question}"])
+        else:
+            fields["prompt"] = question
+        return fields, bool(lines)
+
+    def remember(self, session_id, fields, tokens):
+        """Keep the context tokens of a finished reply for the session's next turn"""
+        if session_id is None or not tokens:
+            return
+        now = time.time()
+        key = self._system_key(fields["system"]) if "system" in fields else None
+        with self._lock:
+            if key is None:
+                # A follow-up turn continues from tokens built with the saved entry's system prompt
+                entry = self._contexts.get(session_id)
+                if entry is None:
+                    return
+                key = entry[1]
+            self._contexts[session_id] = (now, key, list(tokens))
+            self._contexts.move_to_end(session_id)
+            while len(self._contexts) > self.max_sessions:
+                self._contexts.popitem(last=False)
+
+    def forget(self, session_id):
+        with self._lock:
+            self._contexts.pop(session_id, None)
+
+    def _tokens(self, session_id, system):
+        if session_id is None:
+            return None
+        with self._lock:
+            entry = self._contexts.get(session_id)
+            if entry is None:
+                return None
+            saved_at, key, tokens = entry
+            if time.time() - saved_at > self.ttl_seconds or key != self._system_key(system):
+                # A different query type or knowledge-base version needs a fresh prefix
+                del self._contexts[session_id]
+                return None
+            return tokens
+
+    @staticmethod
+    def _system_key(system):
+        return hashlib.sha256(system.encode("utf-8")).hexdigest()[:16]
+
+    def stats(self):
+        with self._lock:
+            sessions = len(self._contexts)
+        return {"sessions": sessions, "reused": self.reused, "windowed": self.windowed}
@@ -0,0 +1,89 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from response_cache import normalize_text
+
+
+class QueryCache:
+    """LRU cache of user-query embeddings and their FAQ match.
+
+    Entries are keyed by the normalized message, so "Hi!" and "hi" share one
+    entry. Each holds the float32 query vector and the match chosen for it as
+    (entry index or None, best score, method), tagged with the knowledge-base
+    version and threshold it was computed for. A new knowledge-base version
+    makes the stored matches stale but keeps the vectors. Vectors depend only
+    on the embedding model, which is fixed for the life of the process, so a
+    model change starts from an empty cache.
+    """
+
+    def __init__(self, max_entries=4096):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.vector_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def vector(self, text):
+        """Return the cached vector of a message, or None"""
+        key = normalize_text(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.vector_hits += 1
+            return entry[0]
+
+    def get(self, text, version, threshold):
+        """Return (vector, match) for a message, or None.
+
+        ``match`` is None when only the vector is usable, because the cached
+        match was computed for another knowledge-base version or threshold.
+        """
+        key = normalize_text(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            vector, match_key, match = entry
+            if match_key == (version, threshold):
+                self.hits += 1
+                return vector, match
+            if match is not None:
+                self.stale += 1
+                self._entries[key] = (vector, None, None)
+            self.vector_hits += 1
+            return vector, None
+
+    def put(self, text, vector, version=None, threshold=None, match=None):
+        """Cache the vector of a message and, if given, the match computed from it"""
+        if self.max_entries <= 0:
+            return
+        key = normalize_text(text)
+        vector = np.asarray(vector, dtype=np.float32)
+        match_key = (version, threshold) if match is not None else None
+        with self._lock:
+            self._entries[key] = (vector, match_key, match)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return size and hit/miss counters"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "vector_hits": self.vector_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "stale": self.stale,
+        }
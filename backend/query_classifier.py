@@ -0,0 +1,37 @@
+import re
+
+
+class QueryClassifier:
+    """Keyword classifier compiled once into a single regular expression.
+
+    ``categories`` is a list of (category, terms) pairs in priority order. All
+    terms are matched in one pass with word boundaries, so 'hi' no longer
+    fires inside "which" or 'ua' inside "evaluate". The first category in
+    priority order with a matching term wins.
+    """
+
+    def __init__(self, categories, default="conversation"):
+        self.default = default
+        self.priority = {category: rank for rank, (category, _) in enumerate(categories)}
+        self.term_categories = {}
+        for category, terms in categories:
+            for term in terms:
+                self.term_categories.setdefault(term.lower(), []).append(category)
+
+        # Longest terms first so multi-word phrases win over their prefixes
+        alternatives = sorted(self.term_categories, key=len, reverse=True)
+        self.pattern = re.compile(
+            r"\b(?:" + "|".join(re.escape(term) for term in alternatives) + r")\b")
+
+    def classify(self, message):
+        """Return (category, matched_terms) for a message"""
+        winner = None
+        matched = {}
+        for term in self.pattern.findall(message.lower()):
+            for category in self.term_categories[term]:
+                matched.setdefault(category, []).append(term)
+                if winner is None or self.priority[category] < self.priority[winner]:
+                    winner = category
+        if winner is None:
+            return self.default, []
+        return winner, matched[winner]
@@ -0,0 +1,119 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+_PUNCTUATION = re.compile(r"[^\w\s]")
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """Fold case, punctuation and whitespace so trivially different messages match"""
+    text = _PUNCTUATION.sub(" ", text.lower())
+    return _WHITESPACE.sub(" ", text).strip()
+
+
+def context_fingerprint(context):
+    """Return a short hash of the prompt context, used to invalidate cached replies"""
+    payload = json.dumps(context, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:16]
+
+
+class ResponseCache:
+    """TTL and LRU cache of LLM generations.
+
+    Entries are keyed by query type, model and normalized prompt. When
+    ``semantic_distance`` is set, a miss on the exact key falls back to the
+    cached reply whose prompt embedding is within that cosine distance of the
+    new one, for the same query type and model. Changing the context
+    fingerprint drops every entry, since the replies were generated from the
+    old context.
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600, semantic_distance=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.semantic_distance = semantic_distance
+        self.context_version = None
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_context(self, context):
+        """Record the current prompt context, invalidating the cache if it changed"""
+        version = context_fingerprint(context)
+        with self._lock:
+            if version != self.context_version:
+                self._entries.clear()
+                self.context_version = version
+
+    def _key(self, query_type, model, prompt):
+        return query_type, model, normalize_text(prompt)
+
+    def _semantic_lookup(self, query_type, model, embedding, now):
+        candidates = [(key, entry) for key, entry in self._entries.items()
+                      if key[0] == query_type and key[1] == model and entry[2] is not None
+                      and now - entry[0] <= self.ttl_seconds]
+        if not candidates:
+            return None
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        similarities = np.stack([entry[2] for _, entry in candidates]) @ query
+        best = int(np.argmax(similarities))
+        if 1.0 - similarities[best] > self.semantic_distance:
+            return None
+        key, entry = candidates[best]
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def get(self, query_type, model, prompt, embedding=None):
+        """Return a cached reply or None"""
+        key = self._key(query_type, model, prompt)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] <= self.ttl_seconds:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            if self.semantic_distance is not None and embedding is not None:
+                reply = self._semantic_lookup(query_type, model, embedding, now)
+                if reply is not None:
+                    self.semantic_hits += 1
+                    return reply
+            self.misses += 1
+            return None
+
+    def put(self, query_type, model, prompt, reply, embedding=None):
+        """Cache a generated reply"""
+        if not reply:
+            return
+        if embedding is not None:
+            embedding = np.asarray(embedding, dtype=np.float32)
+            embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+        key = self._key(query_type, model, prompt)
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        """Return size and hit/miss counters"""
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,165 @@
+import os
+
+import numpy as np
+
+
+def normalize_rows(matrix):
+    """L2-normalize a float32 matrix, leaving zero rows untouched"""
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def save_arrays(path, **arrays):
+    """Atomically replace ``path`` with an .npz of ``arrays``, so readers never see a partial file"""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(temp_path, path)
+
+
+class ExactIndex:
+    """Brute-force inner-product index over normalized vectors.
+
+    Every search scores all rows with one matrix-vector product, which is the
+    fastest option for small corpora.
+    """
+
+    kind = "exact"
+    exhaustive = True
+
+    def __init__(self, vectors, ids=None, normalized=False):
+        if not normalized:
+            vectors = normalize_rows(vectors)
+        self.vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        self.ids = np.arange(len(vectors), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, query, k=None):
+        """Return (ids, scores) of the ``k`` best rows, or of every row when k is None"""
+        scores = self.vectors @ normalize_rows(query).reshape(-1)
+        if k is None or k >= len(scores):
+            return self.ids, scores
+        top = np.argpartition(-scores, k - 1)[:k]
+        return self.ids[top], scores[top]
+
+    def search_many(self, queries):
+        """Return (ids, scores) scoring every row for each query with one matrix-matrix product"""
+        return self.ids, normalize_rows(queries) @ self.vectors.T
+
+    def save(self, path, fingerprint=""):
+        save_arrays(path, kind=self.kind, fingerprint=fingerprint, vectors=self.vectors, ids=self.ids)
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays["vectors"], arrays["ids"], normalized=True)
+
+
+def kmeans(vectors, num_clusters, iterations=10, seed=0):
+    """Spherical k-means; returns normalized centroids"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), num_clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, vectors)
+        # Re-seed empty clusters so every list stays useful
+        empty = np.bincount(assignments, minlength=num_clusters) == 0
+        sums[empty] = vectors[rng.integers(len(vectors), size=int(empty.sum()))]
+        centroids = normalize_rows(sums)
+    return centroids
+
+
+class IVFIndex:
+    """Inverted-file approximate nearest-neighbour index.
+
+    Vectors are clustered into ``nlist`` cells with k-means; a search scores
+    the centroids, then only the rows of the ``nprobe`` closest cells. Raising
+    ``nprobe`` trades latency for recall. Given the ``centroids`` of an
+    earlier index, rows are only assigned to those cells, so a rebuild after
+    an FAQ edit skips k-means.
+    """
+
+    kind = "ivf"
+    exhaustive = False
+
+    def __init__(self, vectors, ids=None, nlist=None, nprobe=8, normalized=False, centroids=None, seed=0):
+        if not normalized:
+            vectors = normalize_rows(vectors)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        ids = np.arange(len(vectors), dtype=np.int64) if ids is None else np.asarray(ids, dtype=np.int64)
+        self.nprobe = nprobe
+        if centroids is None:
+            nlist = nlist or max(1, int(4 * np.sqrt(len(vectors))))
+            centroids = kmeans(vectors, min(nlist, len(vectors)), seed=seed)
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.list_vectors = [np.zeros((0, vectors.shape[1]), dtype=np.float32) for _ in self.centroids]
+        self.list_ids = [np.zeros(0, dtype=np.int64) for _ in self.centroids]
+        self._add(ids, vectors)
+
+    def __len__(self):
+        return sum(len(ids) for ids in self.list_ids)
+
+    def _assign(self, vectors):
+        return np.argmax(vectors @ self.centroids.T, axis=1)
+
+    def search(self, query, k=10):
+        """Return (ids, scores) of up to ``k`` approximate best rows"""
+        query = normalize_rows(query).reshape(-1)
+        nprobe = min(self.nprobe, len(self.centroids))
+        cells = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        ids = np.concatenate([self.list_ids[cell] for cell in cells])
+        if not len(ids):
+            return ids, np.zeros(0, dtype=np.float32)
+        scores = np.concatenate([self.list_vectors[cell] @ query for cell in cells])
+        if k is None or k >= len(scores):
+            return ids, scores
+        top = np.argpartition(-scores, k - 1)[:k]
+        return ids[top], scores[top]
+
+    def _add(self, ids, vectors):
+        """Insert normalized vectors under the given ids into their nearest cells"""
+        cells = self._assign(vectors)
+        for cell in np.unique(cells):
+            members = cells == cell
+            self.list_vectors[cell] = np.vstack([self.list_vectors[cell], vectors[members]])
+            self.list_ids[cell] = np.concatenate([self.list_ids[cell], ids[members]])
+
+    def save(self, path, fingerprint=""):
+        sizes = np.array([len(ids) for ids in self.list_ids], dtype=np.int64)
+        dim = self.centroids.shape[1]
+        save_arrays(path, kind=self.kind, fingerprint=fingerprint, centroids=self.centroids,
+                    nprobe=self.nprobe, sizes=sizes,
+                    vectors=np.vstack(self.list_vectors) if len(self) else np.zeros((0, dim), dtype=np.float32),
+                    ids=np.concatenate(self.list_ids))
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.nprobe = int(arrays["nprobe"])
+        index.centroids = arrays["centroids"]
+        vectors, ids = arrays["vectors"], arrays["ids"]
+        bounds = np.concatenate([[0], np.cumsum(arrays["sizes"])])
+        index.list_vectors = [vectors[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        index.list_ids = [ids[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+        return index
+
+
+INDEX_TYPES = {ExactIndex.kind: ExactIndex, IVFIndex.kind: IVFIndex}
+
+
+def load_index(path, fingerprint):
+    """Load a saved index, or return None if it is missing, unreadable or was built from other data"""
+    try:
+        with np.load(path) as arrays:
+            if str(arrays["fingerprint"]) != fingerprint:
+                return None
+            return INDEX_TYPES[str(arrays["kind"])].from_arrays(arrays)
+    except Exception as e:
+        # A truncated or corrupt file is rebuilt like a missing one
+        if not isinstance(e, FileNotFoundError):
+            print(f"Ignoring saved retrieval index {path}: {str(e)}")
+        return None
@@ -1,532 +1,894 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
-from sentence_transformers import SentenceTransformer
-import numpy as np
-from scipy.spatial.distance import cosine
-import requests
+import contextvars
+import json
+import os
+import random
+import threading
 import time
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
+from batch_encoder import BatchEncoder
+from embedding_backend import create_embedding_backend, default_onnx_dir
+from embedding_store import EmbeddingStore
+from faq_matcher import HybridRetriever
+from generation_scheduler import DisconnectMonitor, GenerationScheduler, QueueFull
+from knowledge_base import KnowledgeBaseLoader
+from llm_pool import create_llm_pool, parse_backends
+from metrics import SCORE_BUCKETS, current_trace, process_memory, record, registry, stage, start_trace
+from prompt_builder import PromptBuilder, estimate_tokens
+from query_cache import QueryCache
+from query_classifier import QueryClassifier
+from retrieval_index import ExactIndex, IVFIndex, load_index
+from response_cache import ResponseCache, normalize_text
+from session_store import create_session_store
+from single_flight import SingleFlight
 
 app = Flask(__name__)
 CORS(app)
 
-# Enhanced context with more detailed information and variations
-TEST_CENTRE_CONTEXT = {
-    "full": """
-You are the Test Centre Assistant at Ontario Tech University. You help students with test accommodations and bookings.
-
-Locations:
-1. North campus: Shawenjigewining Hall (formerly UA), Room 343A
-   - Located on the 3rd floor
-   - Accessible via elevator and stairs
-   - Near the Student Life office
-   
-2. Downtown campus: Charles Hall, Room 236
-   - Located on the 2nd floor
-   - Accessible via elevator and stairs
-   - Near the Student Services desk
-
-Key Policies:
-1. Booking Requirements:
-   - All tests must be booked 7 days in advance minimum
-   - Students must be registered with Student Accessibility Services (SAS)
-   - Each test requires a separate booking through the SAS Portal
-   
-2. Important Deadlines:
-   - Fall 2024 finals registration: November 13, 2024
-   - Winter 2025 finals registration: March 17, 2025
-   
-3. Contact Information:
-   - Email: testcentre@ontariotechu.ca
-   - Response time: Usually within 1-2 business days
-   
-4. Accommodations:
-   - Must be approved by SAS before booking
-   - Need to be renewed each semester
-   - Time extensions are automatically applied to online tests
-
-Always maintain a professional tone while being helpful and understanding. For specific cases 
-not covered by standard policies, direct students to email testcentre@ontariotechu.ca.
-""",
-
-    "location": """
-The Test Centre has two convenient locations at Ontario Tech University:
-
-1. North Campus Location:
-   - Building: Shawenjigewining Hall (formerly UA Building)
-   - Room: 343A (3rd floor)
-   - Landmarks: Near Student Life office, accessible via elevator
-   
-2. Downtown Campus Location:
-   - Building: Charles Hall
-   - Room: 236 (2nd floor)
-   - Landmarks: Near Student Services desk, accessible via elevator
-
-Both locations are fully accessible and equipped with assistive technologies.
-""",
-
-    "booking": """
-Test Centre Booking Information:
-
-1. Advance Notice Required:
-   - All tests/quizzes/midterms: 7 days minimum
-   - Fall 2024 finals deadline: November 13, 2024
-   - Winter 2025 finals deadline: March 17, 2025
-
-2. Booking Process:
-   - Log into SAS Portal
-   - Select "Book Assessment"
-   - Choose course and test date
-   - Verify accommodations
-   - Submit request
-
-3. Requirements:
-   - Must be registered with SAS
-   - Need current accommodation letter
-   - One booking per assessment
-""",
-
-    "contact": """
-Test Centre Contact Information:
-
-Primary Contact:
-- Email: testcentre@ontariotechu.ca
-- Response time: 1-2 business days
-
-When contacting, please include:
-- Your student number
-- Course code
-- Assessment details
-- Specific questions/concerns
-
-For urgent matters during business hours, visit either Test Centre location in person.
-""",
-
-    "accommodation": """
-Test Centre Accommodation Information:
-
-1. Types of Accommodations:
-   - Extended time
-   - Quiet space
-   - Assistive technology
-   - Break time
-   - Reader/scribe services
-
-2. Requirements:
-   - Current SAS registration
-   - Valid medical documentation
-   - Approved accommodation letter
-   - Semester-by-semester renewal
-
-3. Online vs In-Person:
-   - Online: Extra time added automatically in Canvas
-   - In-Person: Accommodations provided at Test Centre
-""",
-
-    "default": """
-As the Test Centre Assistant at Ontario Tech University, provide clear, accurate information 
-about test accommodations, bookings, and policies. Be professional yet approachable. 
-If unsure, recommend contacting testcentre@ontariotechu.ca.
-""",
-    
-    "conversation": """
-You are the friendly Test Centre Assistant at Ontario Tech University. Your role is to:
-- Welcome students warmly while maintaining professionalism
-- Provide clear, accurate information about Test Centre services
-- Show understanding of accommodation needs
-- Guide conversations toward practical solutions
-- Be patient with questions and concerns
-- Offer specific, actionable next steps
-""",
-
-    "greeting": [
-        "Welcome to Ontario Tech's Test Centre! How can I assist you with accommodations or test bookings today?",
-        "Hello! I'm here to help with Test Centre services. What information do you need?",
-        "Hi there! I can help you with test bookings, accommodations, and other Test Centre questions. What brings you here today?",
-        "Welcome! I'm your Test Centre Assistant. How may I help you with your testing needs?"
-    ],
-
-    "farewell": [
-        "Thank you for contacting the Test Centre. Don't hesitate to reach out if you need anything else!",
-        "I hope I've helped answer your questions. Feel free to email testcentre@ontariotechu.ca for any additional support.",
-        "Thanks for your questions! Remember to book your tests at least 7 days in advance. Have a great day!",
-        "Glad I could help! Don't forget to check the SAS Portal for your latest accommodation details."
-    ],
-}
-
-# Expanded FAQ list with more variations and details
-faq = [
-    {
-        "question": "How do I contact the Test Centre?",
-        "variations": [
-            "what's the test centre email",
-            "how can I reach the test centre",
-            "test centre contact info",
-            "who do I contact about accommodations",
-            "test centre phone number",
-            "how to get in touch with test centre",
-            "contact information for testing"
-        ],
-        "answer": "The best way to contact the Test Centre is by email at testcentre@ontariotechu.ca. They typically respond within 1-2 business days. For urgent matters, you can visit either Test Centre location during business hours."
-    },
-    {
-        "question": "Where is the Test Centre located?",
-        "variations": [
-            "test centre building",
-            "where can I find the test centre",
-            "test centre room number",
-            "which building is the test centre in",
-            "test centre campus location",
-            "downtown test centre",
-            "north campus test centre",
-            "UA building test centre",
-            "Charles Hall test centre",
-            "how do I get to the test centre",
-            "directions to test centre",
-            "where is testing services",
-            "test centre floor",
-            "building locations"
-        ],
-        "answer": "The Test Centre has two locations:\n1. North Campus: Shawenjigewining Hall (formerly UA Building), Room 343A (3rd floor, near Student Life)\n2. Downtown Campus: Charles Hall, Room 236 (2nd floor, near Student Services)\n\nBoth locations are accessible via elevator and stairs."
-    },
-    {
-        "question": "What are the booking deadlines for assessments?",
-        "variations": [
-            "when do I need to book by",
-            "test booking deadline",
-            "final exam registration deadline",
-            "when should I book my test",
-            "last day to book",
-            "registration cutoff",
-            "booking timeline",
-            "how far in advance to book",
-            "assessment booking deadline",
-            "deadline for test booking"
-        ],
-        "answer": "All tests, quizzes and mid-terms must be booked a minimum of 7 days in advance of your test date. For Fall 2024 finals, the registration deadline is November 13, 2024. For Winter 2025 finals, the deadline is March 17, 2025. Late bookings require special approval and may not be guaranteed."
-    },
-    {
-        "question": "What happens if I miss the booking deadline?",
-        "variations": [
-            "late test booking",
-            "missed the deadline",
-            "forgot to book test",
-            "past the booking deadline",
-            "too late to book",
-            "can I still book after deadline",
-            "missed registration deadline",
-            "deadline passed",
-            "overdue booking"
-        ],
-        "answer": "If you miss the booking deadline, you must contact testcentre@ontariotechu.ca immediately. While late booking requests are reviewed case-by-case, there's no guarantee they will be approved, and some accommodations may not be available. Always try to book at least 7 days in advance to ensure your accommodations can be provided."
-    },
-    {
-        "question": "How do I book accommodated assessments?",
-        "variations": [
-            "how to book a test",
-            "booking process",
-            "schedule an exam",
-            "make a test booking",
-            "book accommodation",
-            "schedule assessment",
-            "reserve test time",
-            "how to register for test",
-            "exam booking steps",
-            "assessment registration"
-        ],
-        "answer": "To book an accommodated assessment:\n1. Log into the Student Accessibility Services (SAS) Portal\n2. Click on 'Book Assessment'\n3. Select your course and test date\n4. Verify your accommodations\n5. Submit your booking request\n\nRemember: Each assessment requires a separate booking and must be made at least 7 days in advance."
-    },
-    {
-        "question": "What are the requirements for eligibility?",
-        "variations": [
-            "who can use test centre",
-            "test centre eligibility",
-            "accommodation requirements",
-            "can I use test centre",
-            "who is eligible",
-            "qualification for test centre",
-            "documentation needed",
-            "required for accommodations",
-            "registration requirements"
-        ],
-        "answer": "To be eligible for Test Centre services, you must:\n1. Be registered with Student Accessibility Services (SAS)\n2. Have current medical documentation supporting your accommodations\n3. Be authorized by your Accessibility Specialist\n4. Have approved testing accommodations\n5. Renew your accommodations each semester"
-    },
-    {
-        "question": "How do online assessments work?",
-        "variations": [
-            "online test accommodations",
-            "virtual assessment process",
-            "remote testing",
-            "canvas accommodations",
-            "online exam process",
-            "digital assessment",
-            "virtual test taking",
-            "remote exam accommodations"
-        ],
-        "answer": "For online assessments:\n1. TCIS coordinates with your instructors\n2. Time-based accommodations (extra time, breaks) are applied automatically in Canvas\n3. You must still book through the SAS Portal\n4. Technical issues should be reported immediately to testcentre@ontariotechu.ca"
-    },
-    {
-        "question": "Will my accommodations be automatically coordinated?",
-        "variations": [
-            "automatic accommodations",
-            "do I need to request accommodations",
-            "accommodation renewal",
-            "setup accommodations",
-            "accommodation coordination",
-            "accommodation application",
-            "semester accommodation",
-            "course accommodations"
-        ],
-        "answer": "No, accommodations are not automatic. You must:\n1. Opt into accommodations each semester\n2. Review and accept them through the SAS Portal\n3. Send accommodation letters to professors\n4. Book each test separately\n\nIt's your responsibility to ensure accommodations are renewed and properly set up each term."
-    }
-]
-
-def detect_query_type(user_message):
-    """Enhanced query type detection with more context awareness"""
-    msg = user_message.lower()
-    
-    # Location-related terms
-    location_terms = [
-        'where', 'location', 'building', 'room', 'floor', 'campus', 
+# How FAQ matching and LLM generation are scheduled for a /chat request:
+#   staged   - run the FAQ matcher first and only call the LLM on a miss
+#   race     - start both, stop waiting on (and cancel) the LLM once the FAQ hits
+#   parallel - run both and wait for both
+RESPONSE_MODE = os.environ.get("RESPONSE_MODE", "staged")
+FAQ_THRESHOLD = float(os.environ.get("FAQ_THRESHOLD", "0.5"))
+# Directory holding faq.json and context.json (or .yaml); see data/
+KNOWLEDGE_BASE_DIR = os.environ.get(
+    "KNOWLEDGE_BASE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data"))
+# Seconds between checks for edited knowledge-base files; 0 disables the watcher
+KNOWLEDGE_BASE_WATCH_SECONDS = float(os.environ.get("KNOWLEDGE_BASE_WATCH_SECONDS", "0"))
+# Token required by /admin endpoints in the X-Admin-Token header; unset disables them
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN")
+EMBEDDING_MODEL = os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDING_CACHE_DIR = os.environ.get(
+    "EMBEDDING_CACHE_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache"))
+# Embedding runtime: 'torch' (SentenceTransformer) or 'onnx' (exported model on
+# onnxruntime, int8 weights unless EMBEDDING_QUANTIZE=0; exported on first start)
+EMBEDDING_BACKEND = os.environ.get("EMBEDDING_BACKEND", "torch")
+EMBEDDING_ONNX_DIR = os.environ.get("EMBEDDING_ONNX_DIR", default_onnx_dir(EMBEDDING_MODEL, EMBEDDING_CACHE_DIR))
+EMBEDDING_QUANTIZE = os.environ.get("EMBEDDING_QUANTIZE", "1").lower() in ("1", "true", "yes")
+EMBEDDING_THREADS = int(os.environ.get("EMBEDDING_THREADS", "0"))
+# FAQ retrieval index: 'exact' brute force, 'ivf' approximate, or 'auto' to
+# switch to ivf once the corpus has ANN_MIN_ROWS questions and variations
+RETRIEVAL_INDEX = os.environ.get("RETRIEVAL_INDEX", "auto")
+ANN_MIN_ROWS = int(os.environ.get("ANN_MIN_ROWS", "5000"))
+IVF_NLIST = int(os.environ.get("IVF_NLIST", "0")) or None
+IVF_NPROBE = int(os.environ.get("IVF_NPROBE", "8"))
+# Fuse BM25 keyword scores with MiniLM similarity; LEXICAL_FAST_PATH answers exact
+# and short, unambiguous keyword matches without encoding the message
+HYBRID_RETRIEVAL = os.environ.get("HYBRID_RETRIEVAL", "1").lower() in ("1", "true", "yes")
+LEXICAL_FAST_PATH = os.environ.get("LEXICAL_FAST_PATH", "1").lower() in ("1", "true", "yes")
+LEXICAL_MAX_TERMS = int(os.environ.get("LEXICAL_MAX_TERMS", "3"))
+LEXICAL_MARGIN = float(os.environ.get("LEXICAL_MARGIN", "2.0"))
+HYBRID_DENSE_FLOOR = float(os.environ.get("HYBRID_DENSE_FLOOR", "0.3"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+ENCODE_BATCH_SIZE = int(os.environ.get("ENCODE_BATCH_SIZE", "32"))
+ENCODE_BATCH_WAIT_MS = float(os.environ.get("ENCODE_BATCH_WAIT_MS", "2"))
+SESSION_BACKEND = os.environ.get("SESSION_BACKEND", "memory")
+SESSION_DB = os.environ.get("SESSION_DB", os.path.join(EMBEDDING_CACHE_DIR, "sessions.db"))
+SESSION_MAX_MESSAGES = int(os.environ.get("SESSION_MAX_MESSAGES", "50"))
+SESSION_TTL_SECONDS = float(os.environ.get("SESSION_TTL_SECONDS", "3600"))
+SESSION_MAX_SESSIONS = int(os.environ.get("SESSION_MAX_SESSIONS", "10000"))
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("OLLAMA_MODEL", "qwen:0.5b")
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "10"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "3"))
+OLLAMA_READ_TIMEOUT = float(os.environ.get("OLLAMA_READ_TIMEOUT", "60"))
+OLLAMA_MAX_RETRIES = int(os.environ.get("OLLAMA_MAX_RETRIES", "3"))
+OLLAMA_BREAKER_THRESHOLD = int(os.environ.get("OLLAMA_BREAKER_THRESHOLD", "5"))
+OLLAMA_BREAKER_RESET = float(os.environ.get("OLLAMA_BREAKER_RESET", "30"))
+# Ollama-compatible backends as a JSON list of {"host", "model", "name"}; unset uses OLLAMA_HOST and OLLAMA_MODEL
+LLM_BACKENDS = os.environ.get("LLM_BACKENDS")
+# JSON mapping of query type (or "default") to the model, or models in order of preference, answering it
+LLM_ROUTES = json.loads(os.environ.get("LLM_ROUTES") or "{}")
+# Seconds between health probes of the backends when there are several; 0 disables probing
+LLM_HEALTH_CHECK_SECONDS = float(os.environ.get("LLM_HEALTH_CHECK_SECONDS", "30"))
+# How long Ollama keeps the model loaded after a request (Ollama duration, e.g. "30m", "-1" forever)
+OLLAMA_KEEP_ALIVE = os.environ.get("OLLAMA_KEEP_ALIVE", "30m")
+# Estimated tokens of recent conversation written into a prompt when no context tokens can be reused
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "512"))
+# Largest reused Ollama context, in tokens; longer conversations fall back to the history window
+CONTEXT_MAX_TOKENS = int(os.environ.get("CONTEXT_MAX_TOKENS", "1536"))
+# Generations sent to Ollama at once (match OLLAMA_NUM_PARALLEL) and requests allowed to queue for one
+LLM_CONCURRENCY = int(os.environ.get("LLM_CONCURRENCY", "2"))
+LLM_QUEUE_SIZE = int(os.environ.get("LLM_QUEUE_SIZE", "32"))
+# Seconds a chat request may wait for a generation slot before it is dropped; 0 waits indefinitely
+LLM_DEADLINE_SECONDS = float(os.environ.get("LLM_DEADLINE_SECONDS", "30"))
+# Prompts up to this many estimated tokens are queued ahead of longer ones
+SHORT_PROMPT_TOKENS = int(os.environ.get("SHORT_PROMPT_TOKENS", "64"))
+# Normalized user messages whose embedding and FAQ match are kept; 0 disables the cache
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "4096"))
+RESPONSE_CACHE_SIZE = int(os.environ.get("RESPONSE_CACHE_SIZE", "1024"))
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
+# Cosine distance under which an earlier reply is reused for a new query; unset disables it
+RESPONSE_CACHE_SEMANTIC_DISTANCE = os.environ.get("RESPONSE_CACHE_SEMANTIC_DISTANCE")
+# Concurrent LLM generations a /chat/batch request may run, and its largest accepted batch
+BATCH_LLM_CONCURRENCY = int(os.environ.get("BATCH_LLM_CONCURRENCY", "4"))
+BATCH_MAX_MESSAGES = int(os.environ.get("BATCH_MAX_MESSAGES", "1000"))
+# Include a per-stage timing breakdown in every JSON reply, not only when asked for
+TIMINGS_IN_REPLY = os.environ.get("TIMINGS_IN_REPLY", "").lower() in ("1", "true", "yes")
+
+# Shared worker pool for CPU-bound encoding and FAQ matching, reused across requests
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get("WORKER_THREADS", "8")))
+# Threads that block on Ollama, kept apart so slow generations never hold up FAQ matching;
+# by default one for every request that can hold or wait for a generation slot
+llm_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("LLM_WAIT_THREADS", "0")) or LLM_CONCURRENCY + LLM_QUEUE_SIZE)
+
+# Query type keywords, in priority order: greetings and farewells first, then
+# specific query types. Terms match whole words, so inflected forms are listed.
+QUERY_TERMS = [
+    ('greeting', [
+        'hello', 'hi', 'hey', 'good morning', 'good afternoon',
+        'good evening', 'greetings', 'howdy', 'hello there',
+        'hola', 'morning', 'afternoon', 'evening'
+    ]),
+    ('farewell', [
+        'bye', 'goodbye', 'thanks', 'thank you', 'appreciate',
+        'helped', 'clear', 'understood', 'got it', 'see you',
+        'take care', 'have a good day', 'bye bye', 'thank'
+    ]),
+    ('location', [
+        'where', 'location', 'building', 'room', 'floor', 'campus',
         'downtown', 'north', 'ua', 'charles', 'shawenjigewining',
         'find', 'get to', 'directions', 'address', 'situated',
-        'located', 'place', 'building', 'which floor', 'what room'
-    ]
-    
-    # Booking-related terms
-    booking_terms = [
+        'located', 'place', 'which floor', 'what room',
+        'locations', 'buildings', 'rooms', 'floors'
+    ]),
+    ('booking', [
         'book', 'register', 'sign up', 'schedule', 'appointment',
         'deadline', 'date', 'time', 'slot', 'reservation',
         'when', 'available', 'upcoming', 'test date', 'timing',
-        'registration', 'sign-up', 'reserve', 'booking process'
-    ]
-    
-    # Accommodation-related terms
-    accommodation_terms = [
+        'registration', 'sign-up', 'reserve', 'booking process',
+        'booking', 'booked', 'books', 'registered', 'registering',
+        'scheduled', 'scheduling', 'deadlines', 'dates', 'slots'
+    ]),
+    ('accommodation', [
         'accommodation', 'extra time', 'extension', 'quiet',
         'modify', 'change', 'update', 'renew', 'letter',
         'sas', 'accessibility', 'service', 'help', 'support',
-        'extended time', 'special needs', 'assistance', 'aids'
-    ]
-    
-    # Contact-related terms
-    contact_terms = [
+        'extended time', 'special needs', 'assistance', 'aids',
+        'accommodations', 'accommodated', 'extensions', 'letters',
+        'services', 'renewal'
+    ]),
+    ('contact', [
         'contact', 'email', 'reach', 'phone', 'call',
         'speak', 'talk', 'ask', 'question', 'inquire',
-        'get in touch', 'connect', 'message', 'communicate'
-    ]
-    
-    # Greeting detection
-    greetings = [
-        'hello', 'hi', 'hey', 'good morning', 'good afternoon',
-        'good evening', 'greetings', 'howdy', 'hello there',
-        'hola', 'morning', 'afternoon', 'evening'
-    ]
-    
-    # Farewell detection
-    farewells = [
-        'bye', 'goodbye', 'thanks', 'thank you', 'appreciate',
-        'helped', 'clear', 'understood', 'got it', 'see you',
-        'take care', 'have a good day', 'bye bye'
-    ]
-
-    # First, check for greetings and farewells
-    if any(greeting in msg for greeting in greetings):
-        return 'greeting'
-    if any(farewell in msg for farewell in farewells):
-        return 'farewell'
-        
-    # Then check for specific query types
-    if any(term in msg for term in location_terms):
-        return 'location'
-    if any(term in msg for term in booking_terms):
-        return 'booking'
-    if any(term in msg for term in accommodation_terms):
-        return 'accommodation'
-    if any(term in msg for term in contact_terms):
-        return 'contact'
-        
-    # If no specific type is detected, use conversation
-    return 'conversation'
+        'get in touch', 'connect', 'message', 'communicate',
+        'contacting', 'emails', 'questions'
+    ]),
+]
+
+query_classifier = QueryClassifier(QUERY_TERMS, default='conversation')
+
+def detect_query_type(user_message):
+    """Return the query type of a message, e.g. 'location' or 'conversation'"""
+    with stage("classify"):
+        return query_classifier.classify(user_message)[0]
+
+llm_client = create_llm_pool(parse_backends(LLM_BACKENDS, OLLAMA_HOST, OLLAMA_MODEL), LLM_ROUTES,
+                             health_interval=LLM_HEALTH_CHECK_SECONDS, keep_alive=OLLAMA_KEEP_ALIVE,
+                             breaker_threshold=OLLAMA_BREAKER_THRESHOLD,
+                             breaker_reset=OLLAMA_BREAKER_RESET,
+                             max_retries=OLLAMA_MAX_RETRIES,
+                             pool_size=OLLAMA_POOL_SIZE,
+                             connect_timeout=OLLAMA_CONNECT_TIMEOUT,
+                             read_timeout=OLLAMA_READ_TIMEOUT)
+
+llm_flights = SingleFlight()
+generation_scheduler = GenerationScheduler(LLM_CONCURRENCY, LLM_QUEUE_SIZE)
+disconnects = DisconnectMonitor()
+response_cache = ResponseCache(
+    RESPONSE_CACHE_SIZE, RESPONSE_CACHE_TTL,
+    float(RESPONSE_CACHE_SEMANTIC_DISTANCE) if RESPONSE_CACHE_SEMANTIC_DISTANCE else None)
 
 # Initialize model and cache
-print("Loading sentence transformer model...")
-model = SentenceTransformer("all-MiniLM-L6-v2")
-question_embeddings = {q["question"]: model.encode(q["question"]) for q in faq}
-for faq_item in faq:
-    for variation in faq_item["variations"]:
-        question_embeddings[variation] = model.encode(variation)
+print(f"Loading sentence transformer model ({EMBEDDING_BACKEND} backend)...")
+model = create_embedding_backend(EMBEDDING_BACKEND, EMBEDDING_MODEL, EMBEDDING_ONNX_DIR,
+                                 quantize=EMBEDDING_QUANTIZE, threads=EMBEDDING_THREADS)
+query_encoder = BatchEncoder(model.encode, ENCODE_BATCH_SIZE, ENCODE_BATCH_WAIT_MS)
+query_cache = QueryCache(QUERY_CACHE_SIZE)
+# Keyed by backend name so int8 vectors never mix with the reference model's
+embedding_store = EmbeddingStore(EMBEDDING_CACHE_DIR, model.name)
+
+def build_faq_index(texts, embeddings, previous=None):
+    """Build the retrieval index, reusing a saved approximate index when the FAQ is unchanged.
+
+    On a reload the cells of the previous approximate index are kept, so new
+    rows are only assigned to them instead of re-running k-means.
+    """
+    kind = RETRIEVAL_INDEX
+    if kind == "auto":
+        kind = "ivf" if len(embeddings) >= ANN_MIN_ROWS else "exact"
+    if kind == "exact":
+        return ExactIndex(embeddings, normalized=True)
+    if kind != "ivf":
+        raise ValueError(f"Unknown retrieval index: {kind}")
+
+    path = embedding_store.index_path(kind)
+    fingerprint = embedding_store.fingerprint(texts, IVF_NLIST)
+    index = load_index(path, fingerprint)
+    if index is None:
+        centroids = previous.centroids if isinstance(previous, IVFIndex) else None
+        index = IVFIndex(embeddings, nlist=IVF_NLIST, nprobe=IVF_NPROBE, normalized=True, centroids=centroids)
+        try:
+            index.save(path, fingerprint)
+        except OSError as e:
+            print(f"Could not save retrieval index: {str(e)}")
+    index.nprobe = IVF_NPROBE
+    return index
+
+def knowledge_changed(current, previous):
+    """Drop cached LLM replies when the context they were generated from changes"""
+    response_cache.set_context(current.context)
+
+knowledge = KnowledgeBaseLoader(KNOWLEDGE_BASE_DIR, embedding_store, query_encoder.encode_many,
+                                build_faq_index, on_change=knowledge_changed)
+knowledge.reload()
+hybrid = HybridRetriever(RRF_K, LEXICAL_MAX_TERMS, LEXICAL_MARGIN, HYBRID_DENSE_FLOOR,
+                         fast_path=LEXICAL_FAST_PATH)
 print("Model loaded and embeddings cached successfully!")
 
+def query_vector(text):
+    """Return the embedding of a user message, from the query cache when possible"""
+    vector = query_cache.vector(text)
+    if vector is None:
+        vector = query_encoder.encode(text)
+        query_cache.put(text, vector)
+    return vector
+
 def find_best_match(user_input, threshold=0.5):
-    """Find best matching FAQ entry using semantic search"""
+    """Find best matching FAQ entry using keyword and semantic search"""
     try:
-        user_embedding = model.encode(user_input)
-        
-        # Calculate similarities with all questions and variations
-        similarities = {}
-        for faq_item in faq:
-            # Check main question
-            main_similarity = 1 - cosine(user_embedding, question_embeddings[faq_item["question"]])
-            similarities[faq_item["answer"]] = max(similarities.get(faq_item["answer"], 0), main_similarity)
-            
-            # Check variations
-            for variation in faq_item["variations"]:
-                var_similarity = 1 - cosine(user_embedding, question_embeddings[variation])
-                similarities[faq_item["answer"]] = max(similarities.get(faq_item["answer"], 0), var_similarity)
-        
-        # Find best match
-        best_answer = max(similarities.items(), key=lambda x: x[1])
-        
-        if best_answer[1] < threshold:
-            return None
-        return best_answer[0]
-        
+        kb = knowledge.current
+        lexical_scores = None
+        if HYBRID_RETRIEVAL:
+            with stage("lexical"):
+                entry, method, lexical_scores = hybrid.lexical(kb.lexical, user_input)
+            if entry is not None:
+                faq_matches.inc(method)
+                return kb.faq[entry]["answer"]
+
+        with stage("query_cache"):
+            cached = query_cache.get(user_input, kb.version, threshold)
+        if cached is not None and cached[1] is not None:
+            return pick_answer(kb, cached[1])
+        if cached is not None:
+            user_embedding = cached[0]
+        else:
+            with stage("encode"):
+                user_embedding = query_encoder.encode(user_input)
+        with stage("similarity"):
+            dense_scores = kb.matcher.entry_scores(user_embedding, k=1)
+        match = match_entry(dense_scores, lexical_scores, threshold)
+        query_cache.put(user_input, user_embedding, kb.version, threshold, match)
+        return pick_answer(kb, match)
+
     except Exception as e:
         print(f"Error in find_best_match: {str(e)}")
         return None
 
-def get_llm_response(prompt, max_retries=3):
-    """Get response from LLM with enhanced context awareness and retry logic"""
-    query_type = detect_query_type(prompt)
-    context = TEST_CENTRE_CONTEXT.get(query_type, TEST_CENTRE_CONTEXT["default"])
+def match_entry(dense_scores, lexical_scores, threshold):
+    """Return (entry index or None below the threshold, best score, method) from per-entry scores"""
+    if lexical_scores is not None:
+        return hybrid.fuse_scores(dense_scores, lexical_scores, threshold)
+    best_score = float(dense_scores.max()) if len(dense_scores) else -1.0
+    if best_score >= threshold:
+        return int(dense_scores.argmax()), best_score, "dense"
+    return None, best_score, None
+
+def pick_answer(kb, match):
+    """Record a match from match_entry and return its FAQ answer, or None"""
+    entry, best_score, method = match
+    if best_score > -1:
+        faq_best_score.observe(best_score)
+    if entry is None:
+        return None
+    faq_matches.inc(method)
+    return kb.faq[entry]["answer"]
+
+def find_best_matches(messages, threshold=0.5):
+    """Batch version of find_best_match: one encode call and one matrix-matrix product"""
+    kb = knowledge.current
+    answers = [None] * len(messages)
+    pending = []
+    for i, message in enumerate(messages):
+        lexical_scores = None
+        if HYBRID_RETRIEVAL:
+            entry, method, lexical_scores = hybrid.lexical(kb.lexical, message)
+            if entry is not None:
+                faq_matches.inc(method)
+                answers[i] = kb.faq[entry]["answer"]
+                continue
+        cached = query_cache.get(message, kb.version, threshold)
+        if cached is not None and cached[1] is not None:
+            answers[i] = pick_answer(kb, cached[1])
+            continue
+        pending.append((i, lexical_scores, cached[0] if cached is not None else None))
+    if not pending:
+        return answers
+
+    # Encode each distinct uncached message once
+    missing = list(dict.fromkeys(messages[i] for i, _, vector in pending if vector is None))
+    if missing:
+        with stage("encode"):
+            encoded = dict(zip(missing, query_encoder.encode_many(missing)))
+    embeddings = [vector if vector is not None else encoded[messages[i]] for i, _, vector in pending]
+    with stage("similarity"):
+        dense_scores = kb.matcher.entry_scores_many(embeddings, k=1)
+    for (i, lexical_scores, _), vector, scores in zip(pending, embeddings, dense_scores):
+        match = match_entry(scores, lexical_scores, threshold)
+        query_cache.put(messages[i], vector, kb.version, threshold, match)
+        answers[i] = pick_answer(kb, match)
+    return answers
+
+prompts = PromptBuilder(HISTORY_TOKEN_BUDGET, CONTEXT_MAX_TOKENS, OLLAMA_KEEP_ALIVE,
+                        options={"temperature": 0.7, "num_predict": 150},
+                        max_sessions=SESSION_MAX_SESSIONS, ttl_seconds=SESSION_TTL_SECONDS)
+
+def build_llm_request(prompt, query_type, session_id=None):
+    """Return (fields, uses_history) for an Ollama generation in a session"""
+    history = []
+    if session_id is not None:
+        # The current question was already appended; it goes in the prompt itself
+        history = sessions.history(session_id)[:-1]
+    return prompts.build(knowledge.current.context, prompt, query_type, session_id, history)
+
+def remember_context(session_id, fields, cancel_event=None):
+    """Return a callback that keeps Ollama's context tokens unless the reply was abandoned"""
+    def remember(tokens):
+        if cancel_event is None or not cancel_event.is_set():
+            prompts.remember(session_id, fields, tokens)
+    return remember
+
+def canned_reply(query_type):
+    """Return a canned greeting or farewell, or None for other query types"""
+    if query_type in ('greeting', 'farewell'):
+        return random.choice(knowledge.current.context[query_type])
+    return None
+
+def cache_embedding(prompt):
+    """Return the prompt embedding when semantic response caching is enabled"""
+    if response_cache.semantic_distance is None:
+        return None
+    return query_vector(prompt)
+
+# Generation priorities, served lowest first
+PRIORITY_SHORT, PRIORITY_LONG, PRIORITY_BATCH = 0, 1, 2
+
+def generation_priority(query_type, fields):
+    """Queue short conversational turns ahead of long prompts"""
+    if query_type == "conversation" or estimate_tokens(fields["prompt"]) <= SHORT_PROMPT_TOKENS:
+        return PRIORITY_SHORT
+    return PRIORITY_LONG
+
+def generation_deadline(batch=False):
+    """Return the time.monotonic() after which a queued generation is dropped, or None"""
+    if batch or LLM_DEADLINE_SECONDS <= 0:
+        return None
+    return time.monotonic() + LLM_DEADLINE_SECONDS
+
+def get_llm_response(prompt, query_type=None, cancel_event=None, session_id=None, batch=False):
+    """Get response from LLM with enhanced context awareness and retry logic.
+
+    The generation waits for a slot in the generation scheduler; ``batch``
+    work is queued behind interactive requests and has no deadline. Setting
+    ``cancel_event`` drops the request from the queue or stops its
+    generation. Raises QueueFull when the queue is full.
+    """
+    query_type = query_type or detect_query_type(prompt)
     
     # Handle greeting and farewell specially
-    if query_type == 'greeting':
-        import random
-        return random.choice(TEST_CENTRE_CONTEXT["greeting"])
-    
-    if query_type == 'farewell':
-        import random
-        return random.choice(TEST_CENTRE_CONTEXT["farewell"])
-
-    # Construct prompt based on query type
-    if query_type == 'location':
-        full_prompt = f"{TEST_CENTRE_CONTEXT['location']}\nQuestion: {prompt}\nProvide specific location details in a clear, helpful way:"
-    elif query_type == 'booking':
-        full_prompt = f"{TEST_CENTRE_CONTEXT['booking']}\nQuestion: {prompt}\nProvide specific booking information and next steps:"
-    elif query_type == 'accommodation':
-        full_prompt = f"{TEST_CENTRE_CONTEXT['accommodation']}\nQuestion: {prompt}\nExplain accommodation details clearly:"
-    elif query_type == 'conversation':
-        full_prompt = f"{context}\nBe friendly but professional. Question: {prompt}\nResponse:"
-    else:
-        full_prompt = f"{context}\nQ: {prompt}\nA:"
+    reply = canned_reply(query_type)
+    if reply:
+        return reply
+
+    with stage("response_cache"):
+        embedding = cache_embedding(prompt)
+        cached = response_cache.get(query_type, llm_client.model, prompt, embedding)
+    if cached:
+        return cached
+
+    fields, uses_history = build_llm_request(prompt, query_type, session_id)
+    priority = PRIORITY_BATCH if batch else generation_priority(query_type, fields)
+    deadline = generation_deadline(batch)
+
+    def generate(cancel):
+        with generation_scheduler.slot(priority, deadline, cancel) as granted:
+            if not granted:
+                return None
+            return llm_client.generate(cancel_event=cancel, on_context=remember_context(session_id, fields, cancel),
+                                       query_type=query_type, **fields)
 
-    for attempt in range(max_retries):
+    with stage("llm_generate"):
+        if uses_history:
+            result = generate(cancel_event)
+        else:
+            # Identical questions asked at the same moment share one generation,
+            # which is only cancelled once every request waiting on it is
+            result = llm_flights.do((query_type, llm_client.model, normalize_text(prompt)), generate,
+                                    cancel_event=cancel_event)
+    # Replies that depend on earlier turns are not reusable for other sessions
+    if not uses_history:
+        response_cache.put(query_type, llm_client.model, prompt, result, embedding)
+    return result
+
+def stream_llm_response(prompt, query_type=None, session_id=None, cancel_event=None):
+    """Yield LLM response tokens as Ollama generates them, holding a scheduler slot throughout"""
+    query_type = query_type or detect_query_type(prompt)
+    reply = canned_reply(query_type)
+    if reply:
+        yield reply
+        return
+
+    embedding = cache_embedding(prompt)
+    cached = response_cache.get(query_type, llm_client.model, prompt, embedding)
+    if cached:
+        yield cached
+        return
+
+    fields, uses_history = build_llm_request(prompt, query_type, session_id)
+    tokens = []
+    done = []
+    with generation_scheduler.slot(generation_priority(query_type, fields), generation_deadline(),
+                                   cancel_event) as granted:
+        if not granted:
+            return
+        for token in llm_client.stream(cancel_event=cancel_event, on_context=remember_context(session_id, fields),
+                                       query_type=query_type, on_done=lambda: done.append(True), **fields):
+            tokens.append(token)
+            yield token
+    # Only replies Ollama finished are cached, not ones cut short by a disconnect or failure
+    if done and not uses_history:
+        response_cache.put(query_type, llm_client.model, prompt, "".join(tokens).strip(), embedding)
+
+def submit(stage_name, func, *args, pool=None):
+    """Run ``func`` on ``pool`` (the shared pool by default) as a timed stage of the current request.
+
+    The request's trace is carried over to the worker thread, and the time
+    spent waiting for a free worker is recorded as '<stage_name>_queue'.
+    """
+    context = contextvars.copy_context()
+    submitted = time.perf_counter()
+
+    def run():
+        record(stage_name + "_queue", time.perf_counter() - submitted)
+        with stage(stage_name):
+            return func(*args)
+
+    return (pool or executor).submit(context.run, run)
+
+def parallel_get_responses(user_message, mode=None, query_type=None, session_id=None, cancel_event=None):
+    """Get FAQ and LLM responses, only waiting on the LLM when the FAQ misses.
+
+    Returns (faq_response, llm_response, path) where path is 'faq', 'llm' or
+    'fallback' depending on which answer will be used. ``cancel_event`` is
+    set by the caller when the client has gone away.
+    """
+    mode = mode or RESPONSE_MODE
+    query_type = query_type or detect_query_type(user_message)
+
+    if mode == "staged":
+        with stage("faq"):
+            faq_response = find_best_match(user_message, FAQ_THRESHOLD)
+        if faq_response:
+            return faq_response, None, "faq"
+        with stage("llm"):
+            llm_response = get_llm_response(user_message, query_type, cancel_event, session_id)
+
+    elif mode == "race":
+        cancel_event = cancel_event or threading.Event()
+        llm_future = submit("llm", get_llm_response, user_message, query_type, cancel_event, session_id,
+                            pool=llm_executor)
+        with stage("faq"):
+            faq_response = find_best_match(user_message, FAQ_THRESHOLD)
+        if faq_response:
+            # Drop the generation if it has not started, and stop its retries if it has
+            cancel_event.set()
+            llm_future.cancel()
+            return faq_response, None, "faq"
+        llm_response = llm_future.result()
+
+    else:
+        faq_future = submit("faq", find_best_match, user_message, FAQ_THRESHOLD)
+        llm_future = submit("llm", get_llm_response, user_message, query_type, cancel_event, session_id,
+                            pool=llm_executor)
+        faq_response = faq_future.result()
         try:
-            response = requests.post('http://localhost:11434/api/generate',
-                                   json={
-                                       "model": "qwen:0.5b",
-                                       "prompt": full_prompt,
-                                       "stream": False,
-                                       "temperature": 0.7,
-                                       "max_tokens": 150
-                                   },
-                                   timeout=60)
-            
-            if response.status_code == 200:
-                result = response.json().get('response', '').strip()
-                if result:
-                    return result
-                
-        except Exception as e:
-            print(f"LLM error attempt {attempt + 1}: {str(e)}")
-            if attempt == max_retries - 1:
-                return None
-            time.sleep(1)  # Brief pause before retry
-            
-    return None
+            llm_response = llm_future.result()
+        except QueueFull:
+            # A full generation queue only turns the request away when there is no FAQ answer
+            if not faq_response:
+                raise
+            llm_response = None
+        if faq_response:
+            return faq_response, llm_response, "faq"
+
+    return None, llm_response, "llm" if llm_response else "fallback"
+
+# Bounded conversation history shared by all requests
+if SESSION_BACKEND == "sqlite":
+    os.makedirs(os.path.dirname(SESSION_DB) or ".", exist_ok=True)
+sessions = create_session_store(SESSION_BACKEND, path=SESSION_DB,
+                                max_messages=SESSION_MAX_MESSAGES,
+                                ttl_seconds=SESSION_TTL_SECONDS,
+                                max_sessions=SESSION_MAX_SESSIONS)
+
+def record_turn(session_id, role, message):
+    """Add a message to a session's history; requests without a session id keep none"""
+    if session_id is not None:
+        sessions.append(session_id, role, message)
+
+BOOKING_STEPS = ("To book a test, follow these steps:\n"
+                 "1. Log into the Student Accessibility Services (SAS) Portal\n"
+                 "2. Select 'Book Assessment'\n"
+                 "3. Choose your course and test date\n"
+                 "4. Submit your booking at least 7 days in advance\n\n"
+                 "Need help with any of these steps?")
+
+FALLBACK_REPLY = "I apologize, but I'm not sure about that specific query. How else can I help you with the Test Centre today?"
+BUSY_REPLY = "The Test Centre Assistant is busy right now. Please try again in a moment."
+
+# Metrics exposed on /metrics; FAQ hit and LLM fallback rates come from the path label
+chat_replies = registry.counter("chat_replies_total", "Chat replies by the path that produced them", labels=("path",))
+chat_errors = registry.counter("chat_errors_total", "Chat requests that failed with an error")
+faq_matches = registry.counter("faq_matches_total", "FAQ answers by how they were matched",
+                               labels=("method",))
+faq_best_score = registry.histogram("faq_best_score", "Best FAQ similarity score per query", buckets=SCORE_BUCKETS)
+registry.gauge("llm_retries", "Ollama retries since start", lambda: llm_client.retries)
+registry.gauge("llm_failures", "Failed Ollama attempts since start", lambda: llm_client.failures)
+registry.gauge("llm_rejected", "Ollama calls rejected by the open circuit breaker", lambda: llm_client.rejected)
+registry.gauge("llm_breaker_open", "Ollama backends whose circuit breaker is open",
+               lambda: llm_client.open_breakers)
+registry.gauge("llm_failovers", "Generations moved to another backend after one failed", lambda: llm_client.failovers)
+registry.gauge("llm_backend", "Health, circuit breaker, requests in flight, requests and failures per Ollama backend",
+               llm_client.stats, labels=("backend", "stat"))
+registry.gauge("llm_coalescing", "Generations in flight, requests waiting on them and how many were coalesced",
+               lambda: {(name,): value for name, value in llm_flights.stats().items()}, labels=("stat",))
+registry.gauge("llm_scheduler", "Generation queue length, running generations and admission counters",
+               lambda: {(name,): value for name, value in generation_scheduler.stats().items()}, labels=("stat",))
+registry.gauge("client_disconnects", "Requests whose LLM work was cancelled because the client disconnected",
+               lambda: disconnects.disconnects)
+registry.gauge("query_cache", "Query embedding and FAQ match cache size and counters",
+               lambda: {(name,): value for name, value in query_cache.stats().items()}, labels=("stat",))
+registry.gauge("response_cache", "Response cache size and counters",
+               lambda: {(name,): value for name, value in response_cache.stats().items()}, labels=("stat",))
+registry.gauge("session_store", "Session store size and eviction counters",
+               lambda: {(name,): value for name, value in sessions.stats().items()
+                        if name != "backend"}, labels=("stat",))
+registry.gauge("encoder_batches", "Batched encode calls made for user queries", lambda: query_encoder.batches)
+registry.gauge("knowledge_base_reloads", "Knowledge-base versions loaded since start", lambda: knowledge.reloads)
+registry.gauge("knowledge_base_entries", "FAQ entries in the live knowledge base",
+               lambda: len(knowledge.current.faq))
+registry.gauge("prompt_contexts", "Sessions with reusable Ollama context tokens and how prompts were built",
+               lambda: {(name,): value for name, value in prompts.stats().items()}, labels=("stat",))
+registry.gauge("encoder_texts", "User queries encoded through the batch encoder", lambda: query_encoder.encoded)
+registry.gauge("process_memory_bytes", "Memory of this worker process; pss counts pages shared with other workers in part",
+               lambda: {(kind,): value for kind, value in process_memory().items()}, labels=("kind",))
+
+def reply_payload(payload, path, data):
+    """Count the reply and attach the timing breakdown when requested.
+
+    The breakdown is a copy: a generation abandoned in race mode may still
+    record stages into the live trace while the reply is serialized.
+    """
+    chat_replies.inc(path)
+    if TIMINGS_IN_REPLY or data.get("timings"):
+        payload["timings"] = dict(current_trace() or {})
+    return payload
+
+def reply_json(payload, path, data):
+    """JSON response for reply_payload"""
+    return jsonify(reply_payload(payload, path, data))
+
+def chat_message(data):
+    """Return the stripped message of a chat request body, or None when it is not a string"""
+    message = data.get("message", "") if isinstance(data, dict) else None
+    return message.strip() if isinstance(message, str) else None
+
+def invalid_message():
+    """400 reply for a chat request without a string message"""
+    return jsonify({"error": "message must be a string"}), 400
+
+def busy_reply():
+    """503 reply for a request turned away because the generation queue is full"""
+    chat_replies.inc("busy")
+    response = jsonify({"reply": BUSY_REPLY, "source": "system", "path": "busy"})
+    response.status_code = 503
+    return response
+
+def quick_reply(session_id, user_message, query_type):
+    """Answer greetings and booking follow-ups without FAQ matching or generation.
+
+    Returns (reply, source, path) or None when the message needs the full pipeline.
+    """
+    is_follow_up = session_id is not None and sessions.length(session_id) > 1
+    
+    # For greetings and general conversation
+    if query_type == 'greeting' and not is_follow_up:
+        llm_response = get_llm_response(user_message, query_type)
+        return llm_response or "Hello! How can I help you with the Test Centre today?", "llm", "greeting"
+    
+    # For booking follow-ups
+    if is_follow_up and "book" in user_message.lower():
+        return BOOKING_STEPS, "system", "booking_follow_up"
 
-def parallel_get_responses(user_message):
-    """Get FAQ and LLM responses in parallel with enhanced error handling"""
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        faq_future = executor.submit(find_best_match, user_message)
-       
-        llm_future = executor.submit(get_llm_response, user_message)
-        
-        return faq_future.result(), llm_future.result()
+    return None
 
-# Add this at the top level of your file
-conversation_history = {}
+def batch_items(items):
+    """Normalize batch items given as strings or {"message", "session_id"} objects.
+
+    Raises ValueError for an item that is neither, or whose message is not a string.
+    """
+    normalized = []
+    for number, item in enumerate(items):
+        if isinstance(item, str):
+            item = {"message": item}
+        if not isinstance(item, dict) or not isinstance(item.get("message", ""), str):
+            raise ValueError(f"messages[{number}] must be a string or an object with a string message")
+        normalized.append((item.get("message", "").strip(), item.get("session_id")))
+    return normalized
+
+def batch_concurrency(value):
+    """Return the LLM concurrency a batch asked for, capped at BATCH_LLM_CONCURRENCY"""
+    if value is None:
+        return BATCH_LLM_CONCURRENCY
+    if isinstance(value, bool) or not isinstance(value, int) or value < 1:
+        raise ValueError("concurrency must be a positive integer")
+    return min(value, BATCH_LLM_CONCURRENCY)
+
+def answer_batch(items, concurrency=None):
+    """Answer many messages at once, yielding one result dict per message in order.
+
+    Messages are classified one by one, FAQ-matched together with a single
+    encode call, and only the misses are sent to the LLM, at most
+    ``concurrency`` at a time. Items may be strings or dicts with a
+    "message" and an optional "session_id"; with a session id the turn is
+    recorded in that session's history like a /chat call.
+    """
+    concurrency = concurrency or BATCH_LLM_CONCURRENCY
+    items = batch_items(items)
+    results = []
+    for message, session_id in items:
+        record_turn(session_id, "user", message)
+        query_type = detect_query_type(message) if message else None
+        result = {"message": message, "query_type": query_type}
+        if not message:
+            result.update(reply="Please enter your question about the Test Centre.", source="system", path="empty")
+        else:
+            # Without a session id every message is a first turn, so greetings still get a quick reply
+            quick = quick_reply(session_id, message, query_type)
+            if quick:
+                result.update(zip(("reply", "source", "path"), quick))
+        results.append(result)
+
+    unanswered = [i for i, result in enumerate(results) if "reply" not in result]
+    with stage("faq"):
+        answers = find_best_matches([items[i][0] for i in unanswered], FAQ_THRESHOLD)
+    for i, answer in zip(unanswered, answers):
+        if answer:
+            results[i].update(reply=answer, source="faq", path="faq")
+
+    misses = deque(i for i, result in enumerate(results) if "reply" not in result)
+    futures = {}
+
+    def fill():
+        while misses and len(futures) < concurrency:
+            i = misses.popleft()
+            message, session_id = items[i]
+            futures[i] = llm_executor.submit(get_llm_response, message, results[i]["query_type"], None,
+                                             session_id, batch=True)
+
+    fill()
+    for i, result in enumerate(results):
+        session_id = items[i][1]
+        if i in futures:
+            try:
+                reply = futures.pop(i).result()
+            except Exception as e:
+                print(f"Error in batch generation: {str(e)}")
+                reply = None
+            fill()
+            result.update(reply=reply or FALLBACK_REPLY, source="llm", path="llm" if reply else "fallback")
+        record_turn(session_id, "assistant", result["reply"])
+        if session_id is not None and result["path"] != "llm":
+            prompts.forget(session_id)
+        chat_replies.inc(result["path"])
+        result["index"] = i
+        yield result
+
+@app.route("/metrics")
+def metrics():
+    """Prometheus-style metrics for this worker process"""
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+@app.before_request
+def start_knowledge_watcher():
+    """Start the knowledge-base watcher in the process that serves requests.
+
+    Not at import: the gunicorn master preloads this module too, and a reload
+    running there when a worker is forked would leave the worker holding a
+    locked reload lock.
+    """
+    if KNOWLEDGE_BASE_WATCH_SECONDS > 0:
+        knowledge.watch(KNOWLEDGE_BASE_WATCH_SECONDS)
+
+def admin_allowed(headers):
+    """True when the request carries the configured admin token"""
+    return ADMIN_TOKEN is not None and headers.get("X-Admin-Token") == ADMIN_TOKEN
+
+@app.route("/admin/reload", methods=["POST"])
+def admin_reload():
+    """Reload the knowledge base from KNOWLEDGE_BASE_DIR without restarting"""
+    if not admin_allowed(request.headers):
+        return jsonify({"error": "forbidden"}), 403
+    try:
+        return jsonify(knowledge.reload())
+    except Exception as e:
+        print(f"Error reloading knowledge base: {str(e)}")
+        return jsonify({"error": str(e), "version": knowledge.current.version}), 400
 
 @app.route("/chat", methods=["POST"])
 def chat():
+    start_trace()
+    request_start = time.perf_counter()
+    cancel_event = None
     try:
         data = request.get_json()
-        user_message = data.get("message", "").strip()
-        session_id = data.get("session_id", "default")
+        user_message = chat_message(data)
+        if user_message is None:
+            return invalid_message()
+        session_id = data.get("session_id")
 
-        # Initialize or get conversation history
-        if session_id not in conversation_history:
-            conversation_history[session_id] = []
-        
         # Add user message to history
-        conversation_history[session_id].append({
-            "role": "user", 
-            "message": user_message
-        })
+        record_turn(session_id, "user", user_message)
         
         if not user_message:
-            return jsonify({"reply": "Please enter your question about the Test Centre."})
+            return reply_json({"reply": "Please enter your question about the Test Centre."}, "empty", data)
         
+        # Classify once and pass the result down
         query_type = detect_query_type(user_message)
-        is_follow_up = len(conversation_history[session_id]) > 1
-        
-        # For greetings and general conversation
-        if query_type == 'greeting' and not is_follow_up:
-            llm_response = get_llm_response(user_message)
-            conversation_history[session_id].append({
-                "role": "assistant",
-                "message": llm_response
-            })
-            return jsonify({
-                "reply": llm_response or "Hello! How can I help you with the Test Centre today?",
-                "source": "llm"
-            })
+        quick = quick_reply(session_id, user_message, query_type)
+        if quick:
+            reply, source, path = quick
+            record_turn(session_id, "assistant", reply)
+            prompts.forget(session_id)
+            record("chat", time.perf_counter() - request_start)
+            return reply_json({
+                "reply": reply,
+                "source": source,
+                "path": path
+            }, path, data)
         
-        # For booking follow-ups
-        if is_follow_up and "book" in user_message.lower():
-            booking_response = ("To book a test, follow these steps:\n"
-                              "1. Log into the Student Accessibility Services (SAS) Portal\n"
-                              "2. Select 'Book Assessment'\n"
-                              "3. Choose your course and test date\n"
-                              "4. Submit your booking at least 7 days in advance\n\n"
-                              "Need help with any of these steps?")
-            conversation_history[session_id].append({
-                "role": "assistant",
-                "message": booking_response
-            })
-            return jsonify({
-                "reply": booking_response,
-                "source": "system"
-            })
-        
-        # For other queries, use parallel processing
-        faq_response, llm_response = parallel_get_responses(user_message)
+        # For other queries, try the FAQ first and fall back to the LLM; a client
+        # that disconnects meanwhile cancels its queued or running generation
+        cancel_event = disconnects.watch(request.environ)
+        faq_response, llm_response, path = parallel_get_responses(user_message, query_type=query_type,
+                                                                  session_id=session_id, cancel_event=cancel_event)
+        if path != "llm":
+            # Ollama's saved context no longer matches the conversation the student sees
+            prompts.forget(session_id)
         
         if faq_response:
             final_response = faq_response
         elif llm_response:
             final_response = llm_response
         else:
-            final_response = "I apologize, but I'm not sure about that specific query. How else can I help you with the Test Centre today?"
+            final_response = FALLBACK_REPLY
         
-        conversation_history[session_id].append({
-            "role": "assistant",
-            "message": final_response
-        })
+        record_turn(session_id, "assistant", final_response)
+        record("chat", time.perf_counter() - request_start)
         
-        return jsonify({
+        return reply_json({
             "reply": final_response,
-            "source": "faq" if faq_response else "llm"
-        })
-        
+            "source": "faq" if faq_response else "llm",
+            "path": path
+        }, path, data)
+
+    except QueueFull:
+        return busy_reply()
     except Exception as e:
+        chat_errors.inc()
         print(f"Error in chat: {str(e)}")
         return jsonify({
             "reply": "I'm having trouble processing your request. Please try asking your question again.",
             "error": str(e)
         })
+    finally:
+        if cancel_event is not None:
+            disconnects.unwatch(cancel_event)
+
+@app.route("/chat/batch", methods=["POST"])
+def chat_batch():
+    """Answer a list of messages, streaming one JSON line per message in order"""
+    data = request.get_json() or {}
+    items = data.get("messages")
+    if not isinstance(items, list) or len(items) > BATCH_MAX_MESSAGES:
+        return jsonify({"error": f"messages must be a list of at most {BATCH_MAX_MESSAGES} items"}), 400
+    try:
+        batch_items(items)
+        concurrency = batch_concurrency(data.get("concurrency"))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    def generate():
+        for result in answer_batch(items, concurrency):
+            yield json.dumps(result) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+def sse_event(payload):
+    """Format one Server-Sent Events message"""
+    return f"data: {json.dumps(payload)}\n\n"
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """Stream the reply as Server-Sent Events.
+
+    Each event carries either {"token": ...} or, last, {"done": true, "source": ..., "path": ...}.
+    FAQ answers and quick replies arrive as a single token.
+    """
+    data = request.get_json()
+    user_message = chat_message(data)
+    if user_message is None:
+        return invalid_message()
+    session_id = data.get("session_id")
+
+    record_turn(session_id, "user", user_message)
+    environ = request.environ
+
+    def generate():
+        if not user_message:
+            yield sse_event({"token": "Please enter your question about the Test Centre."})
+            yield sse_event({"done": True, "source": "system", "path": "empty"})
+            return
+
+        query_type = detect_query_type(user_message)
+        quick = quick_reply(session_id, user_message, query_type)
+        if quick is None:
+            faq_response = find_best_match(user_message, FAQ_THRESHOLD)
+            if faq_response:
+                quick = faq_response, "faq", "faq"
+        if quick:
+            reply, source, path = quick
+            record_turn(session_id, "assistant", reply)
+            prompts.forget(session_id)
+            chat_replies.inc(path)
+            yield sse_event({"token": reply})
+            yield sse_event({"done": True, "source": source, "path": path})
+            return
+
+        tokens = []
+        path = "llm"
+        # Notices a disconnect while the request is still queued and nothing is being written
+        cancel_event = disconnects.watch(environ)
+        try:
+            try:
+                for token in stream_llm_response(user_message, query_type, session_id, cancel_event):
+                    tokens.append(token)
+                    yield sse_event({"token": token})
+            except QueueFull:
+                path = "busy"
+                prompts.forget(session_id)
+                tokens.append(BUSY_REPLY)
+                yield sse_event({"token": BUSY_REPLY})
+            if not tokens:
+                path = "fallback"
+                prompts.forget(session_id)
+                tokens.append(FALLBACK_REPLY)
+                yield sse_event({"token": FALLBACK_REPLY})
+            chat_replies.inc(path)
+            yield sse_event({"done": True, "source": "system" if path == "busy" else "llm", "path": path})
+        finally:
+            # Runs when the stream ends or the client disconnects
+            disconnects.unwatch(cancel_event)
+            record_turn(session_id, "assistant", "".join(tokens).strip())
+
+    return Response(stream_with_context(generate()), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
         
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True);
\ No newline at end of file
+    # Single process for development; serve on several cores with gunicorn (gunicorn.conf.py)
+    app.run(host=os.environ.get("HOST", "0.0.0.0"), port=int(os.environ.get("PORT", "5000")),
+            debug=os.environ.get("FLASK_DEBUG", "").lower() in ("1", "true", "yes"), threaded=True)
\ No newline at end of file
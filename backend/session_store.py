@@ -0,0 +1,195 @@
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque, namedtuple
+
+Message = namedtuple("Message", ["role", "message", "created"])
+
+
+class SessionStore(ABC):
+    """Conversation history keyed by session id.
+
+    Every store keeps at most ``max_messages`` recent messages per session,
+    expires sessions idle for longer than ``ttl_seconds`` and evicts the least
+    recently used session once more than ``max_sessions`` are held.
+    """
+
+    def __init__(self, max_messages=50, ttl_seconds=3600, max_sessions=10000):
+        self.max_messages = max_messages
+        self.ttl_seconds = ttl_seconds
+        self.max_sessions = max_sessions
+        self.evicted = 0
+        self.expired = 0
+        self.trimmed = 0
+
+    @abstractmethod
+    def append(self, session_id, role, message):
+        """Add a message to a session, creating the session if needed"""
+
+    @abstractmethod
+    def history(self, session_id, limit=None):
+        """Return the most recent messages of a session, oldest first"""
+
+    def length(self, session_id):
+        """Return how many messages are held for a session"""
+        return len(self.history(session_id))
+
+    @abstractmethod
+    def stats(self):
+        """Return size and eviction counters"""
+
+
+class MemorySessionStore(SessionStore):
+    """In-process store; sessions are kept in least-recently-used order"""
+
+    def __init__(self, **limits):
+        super().__init__(**limits)
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        while self._sessions:
+            session_id, (last_seen, _) = next(iter(self._sessions.items()))
+            if now - last_seen <= self.ttl_seconds:
+                break
+            del self._sessions[session_id]
+            self.expired += 1
+
+    def _get(self, session_id, now):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            return None
+        if now - entry[0] > self.ttl_seconds:
+            del self._sessions[session_id]
+            self.expired += 1
+            return None
+        return entry
+
+    def append(self, session_id, role, message):
+        now = time.time()
+        with self._lock:
+            self._expire(now)
+            entry = self._get(session_id, now)
+            messages = entry[1] if entry else deque(maxlen=self.max_messages)
+            if len(messages) == self.max_messages:
+                self.trimmed += 1
+            messages.append(Message(role, message, now))
+            self._sessions[session_id] = (now, messages)
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+                self.evicted += 1
+
+    def history(self, session_id, limit=None):
+        with self._lock:
+            entry = self._get(session_id, time.time())
+            messages = list(entry[1]) if entry else []
+        return messages[-limit:] if limit else messages
+
+    def length(self, session_id):
+        with self._lock:
+            entry = self._get(session_id, time.time())
+            return len(entry[1]) if entry else 0
+
+    def stats(self):
+        with self._lock:
+            messages = [m for _, history in self._sessions.values() for m in history]
+        return {
+            "backend": "memory",
+            "sessions": len(self._sessions),
+            "messages": len(messages),
+            "message_bytes": sum(len(m.message or "") for m in messages),
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "trimmed": self.trimmed,
+        }
+
+
+class SQLiteSessionStore(SessionStore):
+    """Store backed by a SQLite file so several worker processes share history"""
+
+    def __init__(self, path, **limits):
+        super().__init__(**limits)
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                       "(session_id TEXT PRIMARY KEY, last_seen REAL NOT NULL)")
+            db.execute("CREATE TABLE IF NOT EXISTS messages "
+                       "(id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT NOT NULL, "
+                       "role TEXT NOT NULL, message TEXT, created REAL NOT NULL)")
+            db.execute("CREATE INDEX IF NOT EXISTS messages_session ON messages (session_id, id)")
+            db.execute("CREATE INDEX IF NOT EXISTS sessions_last_seen ON sessions (last_seen)")
+
+    def _connect(self):
+        """Return this thread's connection, opening a new one after a fork"""
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+            self._local.pid = os.getpid()
+        return db
+
+    def _delete_sessions(self, db, where, params):
+        ids = [row[0] for row in db.execute(f"SELECT session_id FROM sessions WHERE {where}", params)]
+        for session_id in ids:
+            db.execute("DELETE FROM messages WHERE session_id = ?", (session_id,))
+            db.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+        return len(ids)
+
+    def append(self, session_id, role, message):
+        now = time.time()
+        with self._connect() as db:
+            self.expired += self._delete_sessions(db, "last_seen < ?", (now - self.ttl_seconds,))
+            db.execute("INSERT INTO sessions (session_id, last_seen) VALUES (?, ?) "
+                       "ON CONFLICT(session_id) DO UPDATE SET last_seen = excluded.last_seen",
+                       (session_id, now))
+            db.execute("INSERT INTO messages (session_id, role, message, created) VALUES (?, ?, ?, ?)",
+                       (session_id, role, message, now))
+            trimmed = db.execute(
+                "DELETE FROM messages WHERE session_id = ? AND id NOT IN "
+                "(SELECT id FROM messages WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.max_messages)).rowcount
+            self.trimmed += max(trimmed, 0)
+            overflow = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0] - self.max_sessions
+            if overflow > 0:
+                self.evicted += self._delete_sessions(
+                    db, "session_id IN (SELECT session_id FROM sessions ORDER BY last_seen LIMIT ?)",
+                    (overflow,))
+
+    def history(self, session_id, limit=None):
+        db = self._connect()
+        row = db.execute("SELECT last_seen FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+        if row is None or time.time() - row[0] > self.ttl_seconds:
+            return []
+        rows = db.execute("SELECT role, message, created FROM messages WHERE session_id = ? "
+                          "ORDER BY id DESC LIMIT ?", (session_id, limit or self.max_messages)).fetchall()
+        return [Message(*row) for row in reversed(rows)]
+
+    def stats(self):
+        db = self._connect()
+        sessions = db.execute("SELECT COUNT(*) FROM sessions").fetchone()[0]
+        messages, message_bytes = db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(message)), 0) FROM messages").fetchone()
+        return {
+            "backend": "sqlite",
+            "sessions": sessions,
+            "messages": messages,
+            "message_bytes": message_bytes,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "trimmed": self.trimmed,
+        }
+
+
+def create_session_store(backend="memory", path=None, **limits):
+    """Build the session store named by ``backend`` ('memory' or 'sqlite')"""
+    if backend == "memory":
+        return MemorySessionStore(**limits)
+    if backend == "sqlite":
+        return SQLiteSessionStore(path or "sessions.db", **limits)
+    raise ValueError(f"Unknown session backend: {backend}")
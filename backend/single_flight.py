@@ -0,0 +1,142 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, wait
+
+
+class FlightStats:
+    """Counters shared by the thread and asyncio single-flight groups"""
+
+    def __init__(self):
+        self.leaders = 0
+        self.coalesced = 0
+        self.waiting = 0
+        self._flights = {}
+
+    def stats(self):
+        """Return in-flight and waiting counts plus the share of calls that were coalesced"""
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._flights),
+            "waiting": self.waiting,
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalescing_rate": round(self.coalesced / total, 4) if total else 0.0,
+        }
+
+
+class CancelGroup:
+    """Cancellation shared by the callers of one flight.
+
+    Behaves like a threading.Event that counts as set only once every
+    caller's cancel event is set; a caller without one never cancels.
+    """
+
+    def __init__(self, poll_interval=0.05):
+        self.poll_interval = poll_interval
+        self._events = []
+
+    def add(self, cancel_event):
+        self._events.append(cancel_event)
+
+    def is_set(self):
+        return all(event is not None and event.is_set() for event in self._events)
+
+    def wait(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.is_set():
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return True
+
+
+class SingleFlight(FlightStats):
+    """Runs at most one call per key at a time; concurrent callers share its result.
+
+    The first caller for a key runs the function in its own thread. Callers
+    that arrive while it is running wait for the same future and get the
+    same result or exception. A caller whose ``cancel_event`` is set stops
+    waiting and gets None. The function receives the flight's CancelGroup
+    as its last argument, which is set only once every caller has cancelled.
+    """
+
+    def __init__(self, poll_interval=0.1):
+        super().__init__()
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, cancel_event=None):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = (Future(), CancelGroup())
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+            flight[1].add(cancel_event)
+            self.waiting += 1
+
+        future, cancel_group = flight
+        try:
+            if not leader:
+                if cancel_event is None:
+                    return future.result()
+                while not cancel_event.is_set():
+                    if wait([future], self.poll_interval).done:
+                        return future.result()
+                return None
+            try:
+                result = func(*args, cancel_group)
+            except BaseException as e:
+                future.set_exception(e)
+                raise
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                if leader:
+                    del self._flights[key]
+
+
+class AsyncSingleFlight(FlightStats):
+    """asyncio counterpart of SingleFlight.
+
+    The shared call runs as its own task. A caller that is cancelled stops
+    waiting without affecting the others, and the task itself is only
+    cancelled once every caller has given up on it.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._waiters = {}
+
+    async def do(self, key, coroutine_function, *args):
+        task = self._flights.get(key)
+        if task is None:
+            task = asyncio.ensure_future(coroutine_function(*args))
+            self._flights[key] = task
+            task.add_done_callback(lambda done: self._land(key, done))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        self.waiting += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._waiters[task] == 1:
+                task.cancel()
+            raise
+        finally:
+            self.waiting -= 1
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+    def _land(self, key, task):
+        if self._flights.get(key) is task:
+            del self._flights[key]
@@ -0,0 +1,144 @@
+"""Tests for the generation scheduler's queue, shared by threads and asyncio tasks.
+
+    python -m unittest test_generation_scheduler
+"""
+import asyncio
+import threading
+import time
+import unittest
+
+from generation_scheduler import GenerationScheduler, QueueFull
+
+
+def wait_until(predicate, timeout=2.0):
+    """Poll ``predicate`` until it is true; fail the test if it never is"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+class SchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.scheduler = GenerationScheduler(slots=1, max_queue=3, poll_interval=0.01)
+        self.order = []
+        self.running = []
+        self.threads = []
+
+    def tearDown(self):
+        self.join()
+        # Never more generations running than slots
+        self.assertLessEqual(max(self.running, default=0), 1)
+
+    def join(self):
+        for thread in self.threads:
+            thread.join(2.0)
+
+    def queue(self, name, priority=0, cancel_event=None):
+        """Wait for a slot in a thread; return it and a dict that gets whether the slot was granted"""
+        result = {}
+
+        def run():
+            with self.scheduler.slot(priority, cancel_event=cancel_event) as granted:
+                if granted:
+                    self.order.append(name)
+                    self.running.append(self.scheduler.running)
+                result["granted"] = granted
+
+        queued = self.scheduler.stats()["queued"]
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.threads.append(thread)
+        wait_until(lambda: self.scheduler.stats()["queued"] == queued + 1)
+        return thread, result
+
+    def test_queue_is_served_by_priority_then_arrival(self):
+        with self.scheduler.slot():
+            self.queue("batch", priority=2)
+            self.queue("first", priority=0)
+            self.queue("second", priority=0)
+        self.join()
+        self.assertEqual(self.order, ["first", "second", "batch"])
+        self.assertEqual(self.scheduler.stats()["admitted"], 4)
+
+    def test_full_queue_rejects_at_once(self):
+        with self.scheduler.slot():
+            for name in ("a", "b", "c"):
+                self.queue(name)
+            with self.assertRaises(QueueFull):
+                with self.scheduler.slot():
+                    pass
+        self.join()
+        self.assertEqual(self.scheduler.stats()["rejected"], 1)
+        self.assertEqual(self.order, ["a", "b", "c"])
+
+    def test_expired_request_leaves_the_queue(self):
+        with self.scheduler.slot():
+            with self.scheduler.slot(deadline=time.monotonic() + 0.05) as granted:
+                self.assertFalse(granted)
+            self.assertEqual(self.scheduler.stats()["queued"], 0)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats["expired"], stats["running"]), (1, 0))
+
+    def test_cancelled_request_leaves_the_queue(self):
+        cancel_event = threading.Event()
+        with self.scheduler.slot():
+            thread, result = self.queue("gone", cancel_event=cancel_event)
+            self.queue("next")
+            cancel_event.set()
+            thread.join(2.0)
+            self.assertFalse(result["granted"])
+            self.assertEqual(self.scheduler.stats()["queued"], 1)
+        self.join()
+        self.assertEqual(self.order, ["next"])
+        self.assertEqual(self.scheduler.stats()["cancelled"], 1)
+
+    def test_threads_and_tasks_share_one_queue(self):
+        async def generate(name, priority):
+            async with self.scheduler.aslot(priority) as granted:
+                if granted:
+                    self.order.append(name)
+                    self.running.append(self.scheduler.running)
+                    await asyncio.sleep(0.01)
+
+        async def run():
+            task = asyncio.ensure_future(generate("async", 1))
+            while self.scheduler.stats()["queued"] < 1:
+                await asyncio.sleep(0.005)
+            await task
+
+        with self.scheduler.slot():
+            loop_thread = threading.Thread(target=asyncio.run, args=(run(),))
+            loop_thread.start()
+            self.threads.append(loop_thread)
+            wait_until(lambda: self.scheduler.stats()["queued"] == 1)
+            self.queue("thread", priority=0)
+            self.queue("last", priority=2)
+        self.join()
+        self.assertEqual(self.order, ["thread", "async", "last"])
+        self.assertEqual(self.scheduler.stats()["running"], 0)
+
+    def test_cancelled_task_leaves_the_queue(self):
+        async def generate():
+            async with self.scheduler.aslot():
+                self.order.append("never")
+
+        async def run():
+            task = asyncio.ensure_future(generate())
+            while self.scheduler.stats()["queued"] < 1:
+                await asyncio.sleep(0.005)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+
+        with self.scheduler.slot():
+            asyncio.run(run())
+            self.assertEqual(self.scheduler.stats()["queued"], 0)
+        stats = self.scheduler.stats()
+        self.assertEqual((stats["cancelled"], stats["running"]), (1, 0))
+        self.assertEqual(self.order, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
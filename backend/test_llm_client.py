@@ -0,0 +1,120 @@
+"""Tests for the Ollama clients' circuit breaker and streaming.
+
+    python -m unittest test_llm_client
+"""
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from llm_client import AsyncOllamaClient, CircuitBreaker, OllamaClient
+
+
+def half_open_breaker():
+    """Return a breaker whose next call is the trial call"""
+    breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.0)
+    breaker.record_failure()
+    assert breaker.state == "half-open"
+    return breaker
+
+
+class FakeResponse:
+    status_code = 200
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def iter_lines(self):
+        for line in self.lines:
+            if isinstance(line, Exception):
+                raise line
+            yield line
+
+
+class CancelledTrialTest(unittest.TestCase):
+    def test_cancel_before_first_token_releases_trial(self):
+        breaker = half_open_breaker()
+        client = OllamaClient(breaker=breaker)
+        cancel_event = threading.Event()
+
+        def post(*args, **kwargs):
+            # The client goes away after the trial call was admitted
+            cancel_event.set()
+            return FakeResponse([b'{"response": "Hi", "done": false}'])
+
+        with mock.patch.object(client.session, "post", side_effect=post):
+            self.assertEqual(list(client.stream("hello", cancel_event)), [])
+        self.assertFalse(breaker.trial_running)
+        self.assertTrue(breaker.allow())
+
+    def test_cancel_before_admission_starts_no_trial(self):
+        breaker = half_open_breaker()
+        client = OllamaClient(breaker=breaker)
+        cancel_event = threading.Event()
+        cancel_event.set()
+
+        with mock.patch.object(client.session, "post", return_value=FakeResponse([])):
+            self.assertIsNone(client.generate("hello", cancel_event))
+        # Cancelled before admission, so no trial was started
+        self.assertTrue(breaker.allow())
+
+    def test_async_cancelled_trial_is_released(self):
+        breaker = half_open_breaker()
+        client = AsyncOllamaClient(breaker=breaker)
+
+        async def post(*args, **kwargs):
+            await asyncio.sleep(60)
+
+        async def run():
+            with mock.patch.object(client.client, "post", side_effect=post):
+                task = asyncio.ensure_future(client.generate("hello"))
+                await asyncio.sleep(0.01)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            await client.aclose()
+
+        asyncio.run(run())
+        self.assertFalse(breaker.trial_running)
+        self.assertTrue(breaker.allow())
+
+    def test_failed_trial_reopens(self):
+        breaker = half_open_breaker()
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.reset_timeout = 60.0
+        breaker.record_failure()
+        self.assertEqual(breaker.state, "open")
+        self.assertFalse(breaker.allow())
+
+
+class IncompleteStreamTest(unittest.TestCase):
+    def generate(self, lines):
+        client = OllamaClient(max_retries=1)
+        done = []
+        with mock.patch.object(client.session, "post", return_value=FakeResponse(lines)):
+            tokens = list(client.stream("hello", on_done=lambda: done.append(True)))
+        with mock.patch.object(client.session, "post", return_value=FakeResponse(lines)):
+            return client.generate("hello", threading.Event()), tokens, bool(done)
+
+    def test_complete_reply(self):
+        lines = [b'{"response": "The Test Centre", "done": false}', b'{"response": " is open", "done": true}']
+        self.assertEqual(self.generate(lines), ("The Test Centre is open", ["The Test Centre", " is open"], True))
+
+    def test_dropped_connection_is_not_a_reply(self):
+        lines = [b'{"response": "The Test Centre is in", "done": false}', ConnectionError("reset")]
+        self.assertEqual(self.generate(lines), (None, ["The Test Centre is in"], False))
+
+    def test_stream_closed_before_done_is_not_a_reply(self):
+        lines = [b'{"response": "The Test Centre is in", "done": false}']
+        self.assertEqual(self.generate(lines), (None, ["The Test Centre is in"], False))
+
+
+if __name__ == "__main__":
+    unittest.main()
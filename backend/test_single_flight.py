@@ -0,0 +1,144 @@
+"""Tests for coalescing identical generations and their shared cancellation.
+
+    python -m unittest test_single_flight
+"""
+import asyncio
+import threading
+import time
+import unittest
+
+from single_flight import AsyncSingleFlight, SingleFlight
+
+
+def wait_until(predicate, timeout=2.0):
+    """Poll ``predicate`` until it is true; fail the test if it never is"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() >= deadline:
+            raise AssertionError("condition not reached")
+        time.sleep(0.005)
+
+
+class SingleFlightTest(unittest.TestCase):
+    def setUp(self):
+        self.flights = SingleFlight(poll_interval=0.01)
+        self.release = threading.Event()
+        self.calls = []
+
+    def generate(self, prompt, cancel_group):
+        """Stand-in generation that runs until released or every caller cancelled"""
+        self.calls.append(cancel_group)
+        while not self.release.wait(0.01):
+            if cancel_group.is_set():
+                return None
+        return f"reply to {prompt}"
+
+    def follow(self, cancel_event=None):
+        """Join the flight for "hello" from another thread; return the thread and its result"""
+        result = {}
+        waiting = self.flights.stats()["waiting"]
+        thread = threading.Thread(target=lambda: result.update(reply=self.flights.do(
+            "hello", self.generate, "hello", cancel_event=cancel_event)))
+        thread.start()
+        wait_until(lambda: self.flights.stats()["waiting"] == waiting + 1)
+        return thread, result
+
+    def test_concurrent_callers_share_one_call(self):
+        leader, leader_result = self.follow()
+        follower, follower_result = self.follow()
+        self.release.set()
+        leader.join(2.0)
+        follower.join(2.0)
+        self.assertEqual(leader_result["reply"], "reply to hello")
+        self.assertEqual(follower_result["reply"], "reply to hello")
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.flights.stats()["coalescing_rate"], 0.5)
+
+    def test_leader_that_leaves_still_answers_the_others(self):
+        leader_cancel, follower_cancel = threading.Event(), threading.Event()
+        leader, _ = self.follow(leader_cancel)
+        follower, follower_result = self.follow(follower_cancel)
+        leader_cancel.set()
+        self.assertFalse(self.calls[0].is_set())
+
+        self.release.set()
+        leader.join(2.0)
+        follower.join(2.0)
+        self.assertEqual(follower_result["reply"], "reply to hello")
+
+    def test_call_is_cancelled_once_every_caller_left(self):
+        leader_cancel, follower_cancel = threading.Event(), threading.Event()
+        leader, leader_result = self.follow(leader_cancel)
+        follower, follower_result = self.follow(follower_cancel)
+        leader_cancel.set()
+        self.assertFalse(self.calls[0].is_set())
+        follower_cancel.set()
+        leader.join(2.0)
+        follower.join(2.0)
+        self.assertTrue(self.calls[0].is_set())
+        self.assertIsNone(leader_result["reply"])
+        self.assertEqual(self.flights.stats()["in_flight"], 0)
+
+    def test_caller_without_cancel_event_never_cancels_the_call(self):
+        follower_cancel = threading.Event()
+        leader, leader_result = self.follow()
+        follower, follower_result = self.follow(follower_cancel)
+        follower_cancel.set()
+        follower.join(2.0)
+        self.assertIsNone(follower_result["reply"])
+        self.assertFalse(self.calls[0].is_set())
+
+        self.release.set()
+        leader.join(2.0)
+        self.assertEqual(leader_result["reply"], "reply to hello")
+
+
+class AsyncSingleFlightTest(unittest.TestCase):
+    def test_cancelled_waiter_leaves_the_call_running(self):
+        flights = AsyncSingleFlight()
+        started = []
+
+        async def generate(prompt):
+            started.append(prompt)
+            await asyncio.sleep(0.05)
+            return f"reply to {prompt}"
+
+        async def run():
+            leaving = asyncio.ensure_future(flights.do("hello", generate, "hello"))
+            staying = asyncio.ensure_future(flights.do("hello", generate, "hello"))
+            await asyncio.sleep(0.01)
+            leaving.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await leaving
+            return await staying
+
+        self.assertEqual(asyncio.run(run()), "reply to hello")
+        self.assertEqual(started, ["hello"])
+        self.assertEqual(flights.stats()["in_flight"], 0)
+
+    def test_call_is_cancelled_once_every_waiter_left(self):
+        flights = AsyncSingleFlight()
+        cancelled = []
+
+        async def generate(prompt):
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.append(prompt)
+                raise
+
+        async def run():
+            waiters = [asyncio.ensure_future(flights.do("hello", generate, "hello")) for _ in range(2)]
+            await asyncio.sleep(0.01)
+            for waiter in waiters:
+                waiter.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+            await asyncio.sleep(0.01)
+
+        asyncio.run(run())
+        self.assertEqual(cancelled, ["hello"])
+        self.assertEqual(flights.stats()["in_flight"], 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -13,6 +13,10 @@ const Chatbot = () => {
   const [isTyping, setIsTyping] = useState(false);
   const [minimized, setMinimized] = useState(false);
   const messagesEndRef = useRef(null);
+  // One conversation per tab, so the backend keeps each student's history apart
+  const sessionId = useRef(
+    window.crypto?.randomUUID?.() || `${Date.now()}-${Math.random().toString(36).slice(2)}`
+  );
   
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
@@ -41,7 +45,7 @@ const Chatbot = () => {
       const response = await fetch("http://localhost:5000/chat", {
         method: "POST",
         headers: { "Content-Type": "application/json" },
-        body: JSON.stringify({ message: input }),
+        body: JSON.stringify({ message: input, session_id: sessionId.current }),
       });
   
       const data = await response.json();